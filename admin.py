@@ -0,0 +1,371 @@
+"""Task queue, cron and admin handlers: purges, notification digests, the
+search and tag index jobs, migrations, backfills and the /stats page.
+"""
+import datetime
+import hashlib
+import os
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import instrument
+import notify
+import ratelimit
+import searchindex
+import unitofwork
+from question import (addToDigest, aggregateVotes, Answer, applyTagDelta, BaseHandler,
+                      clearDigest, countTags, foldedVotes, forgetListItems, invalidatePages,
+                      JobHandler, migrateVote, moveThread, NotificationDigest, NOTIFY_WINDOW,
+                      purgeBatch, Question, renderContent, schedulePurge, SEARCH_ANSWERS, site_key, Tag,
+                      TAG_DELTA_FORMAT, TAG_DELTA_KEEP, tag_key, tag_pair_key,
+                      TAG_REBUILD_BATCH, tag_rebuild_key, TagDelta, TagPair, TagRebuild,
+                      thread_key, Vote, VoteShard)
+
+
+class PurgeHandler(JobHandler):
+    """ task deleting the answers and votes of a deleted question or answer
+        in batches, it re-enqueues itself until nothing is left, so a purge
+        cut short by the deadline resumes where it stopped """
+    def post(self):
+        key = ndb.Key(urlsafe=self.request.get('key'))
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            if not purgeBatch(key):
+                return
+        schedulePurge(key)
+
+class NotifyAnswer(JobHandler):
+    """ task adding an answer to its question author's digest for the
+        current window, the first answer of a window schedules the send """
+    def post(self):
+        answerKey = ndb.Key(urlsafe=self.request.get('answer'))
+        answer, question = ndb.get_multi([answerKey, answerKey.parent()])
+        if not answer or not question or not question.author:
+            return
+        recipient = question.author
+        now = int(time.time())
+        window = now // NOTIFY_WINDOW
+        recipientId = hashlib.md5(recipient.user_id() or recipient.email()).hexdigest()
+        digestKey = ndb.Key(NotificationDigest, '%s-%d' % (recipientId, window))
+        addToDigest(digestKey, recipient, answerKey)
+        try:
+            taskqueue.add(name='digest-%s-%d' % (recipientId, window),
+                          url='/admin/notify/digest', queue_name='notifications',
+                          params={'digest': digestKey.id()},
+                          countdown=(window + 1) * NOTIFY_WINDOW - now)
+        except taskqueue.TaskAlreadyExistsError:
+            pass
+        except taskqueue.TombstonedTaskError:
+            #this window's digest already went out, send the late answer on its own
+            taskqueue.add(url='/admin/notify/digest', queue_name='notifications',
+                          params={'digest': digestKey.id()})
+
+class SendDigest(JobHandler):
+    """ task mailing one digest, failures are retried by the queue """
+    def post(self):
+        digestKey = ndb.Key(NotificationDigest, self.request.get('digest'))
+        digest = digestKey.get()
+        if digest is None:
+            return
+        answers = [answer for answer in ndb.get_multi(digest.answers) if answer]
+        if answers:
+            subject, body = notify.composeDigest(
+                digest.recipient, [(answer.content, answer.author) for answer in answers])
+            notify.getTransport().send(digest.recipient, subject, body)
+        if clearDigest(digestKey, digest.answers):
+            taskqueue.add(url='/admin/notify/digest', queue_name='notifications',
+                          params={'digest': digestKey.id()})
+
+def buildSearchDocuments(questions):
+    """ search documents of questions, their answer queries run in parallel """
+    futures = [Answer.query(ancestor=question.key).order(-Answer.voteResult).fetch_async(SEARCH_ANSWERS)
+               for question in questions]
+    return [searchindex.buildDocument(question, future.get_result())
+            for question, future in zip(questions, futures)]
+
+class IndexQuestion(JobHandler):
+    """ task rebuilding the search document of one thread """
+    def post(self):
+        questionKey = ndb.Key(urlsafe=self.request.get('question'))
+        question = questionKey.get()
+        if question is None:
+            searchindex.delete([questionKey.urlsafe()])
+        else:
+            searchindex.put(buildSearchDocuments([question]))
+
+class RebuildSearchIndex(JobHandler):
+    """ index every question, a batch per run, chaining itself through the
+        task queue """
+    def post(self):
+        self.rebuild()
+
+    def get(self):
+        self.rebuild()
+
+    def rebuild(self):
+        if self.request.get('cursor'):
+            curs = Cursor(urlsafe=self.request.get('cursor'))
+        else:
+            curs = None
+        questions, next_curs, more = Question.query().fetch_page(50, start_cursor=curs)
+        searchindex.put(buildSearchDocuments(questions))
+        if more and next_curs:
+            taskqueue.add(url='/admin/search/rebuild', params={'cursor': next_curs.urlsafe()})
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('%d questions indexed' % len(questions))
+
+@ndb.transactional
+def summarizeQuestion(questionKey):
+    """ recount the thread summary of one question from its answers """
+    question = questionKey.get()
+    if question is None:
+        return
+    answers = Answer.query(ancestor=questionKey).order(-Answer.createTime).fetch(keys_only=True)
+    question.answerCount = len(answers)
+    question.lastActivity = question.modifyTime
+    if answers:
+        latest = answers[0].get()
+        question.lastAnswerTime = latest.modifyTime
+        question.lastAnswerAuthor = latest.author
+        question.lastActivity = max(question.modifyTime, latest.modifyTime)
+    question.put()
+
+class SummaryBackfill(JobHandler):
+    """ recount the summary of every question, a batch per run, chaining
+        itself through the task queue """
+    def post(self):
+        self.backfill()
+
+    def get(self):
+        self.backfill()
+
+    def backfill(self):
+        if self.request.get('cursor'):
+            curs = Cursor(urlsafe=self.request.get('cursor'))
+        else:
+            curs = None
+        keys, next_curs, more = Question.query().fetch_page(50, start_cursor=curs, keys_only=True)
+        for key in keys:
+            summarizeQuestion(key)
+        unitofwork.collect(forgetListItems, *keys)
+        if more and next_curs:
+            taskqueue.add(url='/admin/summarybackfill', params={'cursor': next_curs.urlsafe()})
+        else:
+            unitofwork.collect(invalidatePages, 'list')
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('%d questions summarized' % len(keys))
+
+class RebuildTagIndex(JobHandler):
+    """ repair job, recount the tag index from the questions themselves, a
+        batch per task on the tagindex queue, so the batches and the tag
+        index updates of question writes run one at a time. The counts so
+        far, and when each batch was read, are kept in the TagRebuild
+        entity, see applyTagDelta """
+    def post(self):
+        self.rebuild()
+
+    def get(self):
+        #a new recount, one still running stops at its next batch
+        rebuild = TagRebuild(key=tag_rebuild_key(), started=time.time(), cursor=None,
+                             counts={}, pairs={}, batches=[])
+        saveTagRebuild(rebuild, None, '')
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('tag index recount queued')
+
+    def rebuild(self):
+        self.response.headers['Content-Type'] = 'text/plain'
+        cursor = self.request.get('cursor')
+        rebuild = tag_rebuild_key().get()
+        if rebuild is None or repr(rebuild.started) != self.request.get('started') or \
+                rebuild.cursor != cursor:
+            #a retry of a counted batch, or a recount started since
+            self.response.write('recount moved on')
+            return
+        readTime = time.time()
+        keys, next_curs, more = Question.query().order(Question.key).fetch_page(
+            TAG_REBUILD_BATCH, start_cursor=Cursor(urlsafe=cursor) if cursor else None,
+            keys_only=True)
+        for question in ndb.get_multi(keys):
+            if question:
+                countTags(rebuild, question.tags, question.modifyTime)
+        if more and next_curs:
+            rebuild.batches.append([list(keys[-1].flat()), readTime])
+            saveTagRebuild(rebuild, cursor, next_curs.urlsafe())
+            self.response.write('%d questions counted' % len(keys))
+            return
+        #the questions after the last batch were there to be read too
+        rebuild.batches.append([None, readTime])
+        tags = [Tag(key=tag_key(tag), count=count,
+                    lastActivity=last and datetime.datetime.strptime(last, TAG_DELTA_FORMAT))
+                for tag, (count, last) in rebuild.counts.items() if count > 0]
+        pairs = [TagPair(key=tag_pair_key(a, b), tags=[a, b], count=count)
+                 for a, b, count in rebuild.pairs.values() if count > 0]
+        keep = set(tag.key for tag in tags) | set(pair.key for pair in pairs)
+        stale = [key for key in Tag.query(ancestor=site_key()).fetch(keys_only=True) +
+                 TagPair.query(ancestor=site_key()).fetch(keys_only=True) if key not in keep]
+        #retries of a tag index task come within minutes, older markers can go
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=TAG_DELTA_KEEP)
+        stale.extend(TagDelta.query(TagDelta.createTime < cutoff, ancestor=site_key()).fetch(
+            keys_only=True))
+        #the read times stay for the updates still queued, the counts are in the index
+        rebuild.cursor = None
+        rebuild.counts = {}
+        rebuild.pairs = {}
+        unitofwork.put(*(tags + pairs + [rebuild]))
+        unitofwork.delete(*stale)
+        self.response.write('%d tags and %d tag pairs indexed, %d stale entries removed'
+                            % (len(tags), len(pairs), len(stale)))
+
+@ndb.transactional
+def saveTagRebuild(rebuild, cursor, nextCursor):
+    """ store a recount's progress and queue its next batch together, a
+        retry or a newer recount that got there first wins """
+    if cursor is not None:
+        stored = rebuild.key.get()
+        if stored is None or stored.started != rebuild.started or stored.cursor != cursor:
+            return
+    rebuild.cursor = nextCursor
+    rebuild.put()
+    taskqueue.add(url='/admin/rebuildtags', queue_name='tagindex', transactional=True,
+                  params={'started': repr(rebuild.started), 'cursor': nextCursor})
+
+class AggregateVotes(JobHandler):
+    """ fold vote shards into voteResult, POST from the task queue for one
+        target, GET from cron as a sweep over every target with shards """
+    def post(self):
+        target = ndb.Key(urlsafe=self.request.get('target'))
+        foldedVotes(target, aggregateVotes(target))
+
+    def get(self):
+        targets = set()
+        for key in VoteShard.query().fetch(keys_only=True):
+            targets.add(key.id().rsplit('-', 1)[0])
+        for target in targets:
+            target = ndb.Key(urlsafe=target)
+            foldedVotes(target, aggregateVotes(target))
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('%d targets aggregated' % len(targets))
+
+class MigrateVotes(JobHandler):
+    """ move Vote entities out of the site entity group into their voter's
+        group, a batch per run, chaining itself through the task queue """
+    def post(self):
+        self.migrate()
+
+    def get(self):
+        self.migrate()
+
+    def migrate(self):
+        votes = Vote.query(ancestor=site_key()).fetch(100)
+        for vote in votes:
+            migrateVote(vote)
+        if votes:
+            taskqueue.add(url='/admin/migratevotes')
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('%d votes migrated' % len(votes))
+
+@ndb.transactional(xg=True)
+def renderBatch(keys, host):
+    """ render and store the links of a batch of questions or answers """
+    entities = [entity for entity in ndb.get_multi(keys) if entity]
+    for entity in entities:
+        renderContent(entity, host)
+    ndb.put_multi(entities)
+
+class ApplyTagDelta(JobHandler):
+    """ task applying the tag index update of one question write """
+    def post(self):
+        #the task name marks the update as applied, only the queue can run it
+        taskName = self.request.headers.get('X-AppEngine-TaskName')
+        if not taskName:
+            self.abort(403)
+        if self.request.get('activity'):
+            activity = datetime.datetime.strptime(self.request.get('activity'), TAG_DELTA_FORMAT)
+        else:
+            activity = None
+        #tasks queued before the recount kept its read times carry no question
+        questionKey = self.request.get('question') and ndb.Key(urlsafe=self.request.get('question'))
+        queued = self.request.get('queued') and float(self.request.get('queued'))
+        applyTagDelta(taskName, questionKey, self.request.get_all('old'),
+                      self.request.get_all('new'), activity, queued)
+
+class MigrateQuestions(JobHandler):
+    """ move questions out of the site entity group into their own, a
+        batch per run, chaining itself through the task queue, the threads
+        that stay are logged and listed, another run retries them """
+    def post(self):
+        self.migrate()
+
+    def get(self):
+        self.migrate()
+
+    def migrate(self):
+        #a thread that cannot move yet is stepped over, not fetched again
+        if self.request.get('cursor'):
+            curs = Cursor(urlsafe=self.request.get('cursor'))
+        else:
+            curs = None
+        keys, next_curs, more = Question.query(ancestor=site_key()).fetch_page(
+            20, start_cursor=curs, keys_only=True)
+        stayed = [key for key in keys if not moveThread(key)]
+        if more and next_curs:
+            taskqueue.add(url='/admin/migratequestions', params={'cursor': next_curs.urlsafe()})
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('%d questions moved' % (len(keys) - len(stayed)))
+        if stayed:
+            self.response.write(', %d stayed: %s' % (len(stayed), ' '.join(str(key.id()) for key in stayed)))
+
+class RenderBackfill(JobHandler):
+    """ fill contentHtml of questions and answers written before it existed,
+        a batch per run, chaining itself through the task queue """
+    def post(self):
+        self.backfill()
+
+    def get(self):
+        self.backfill()
+
+    def backfill(self):
+        kind = self.request.get('kind') or 'Question'
+        #links to uploaded images are recognised by the public host
+        host = self.request.get('host') or os.environ['HTTP_HOST']
+        if self.request.get('cursor'):
+            curs = Cursor(urlsafe=self.request.get('cursor'))
+        else:
+            curs = None
+        #a batch spans one entity group per thread, within the cross group limit
+        keys, next_curs, more = ndb.Query(kind=kind).fetch_page(20, start_cursor=curs, keys_only=True)
+        if keys:
+            renderBatch(keys, host)
+        #cached list items carry the question excerpts, thread pages the bodies
+        if kind == 'Question':
+            unitofwork.collect(forgetListItems, *keys)
+        unitofwork.collect(invalidatePages, *set('view:' + thread_key(key).urlsafe() for key in keys))
+        if more and next_curs:
+            taskqueue.add(url='/admin/renderbackfill',
+                          params={'kind': kind, 'host': host, 'cursor': next_curs.urlsafe()})
+        elif kind == 'Question':
+            unitofwork.collect(invalidatePages, 'list')
+            taskqueue.add(url='/admin/renderbackfill', params={'kind': 'Answer', 'host': host})
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('%d %s entities rendered' % (len(keys), kind))
+
+class StatsPage(BaseHandler):
+    """ admin page with per route latency, datastore and render percentiles
+        of the requests this instance served """
+    def get(self):
+        if not self.admin:
+            self.abort(403)
+        if self.request.get('reset'):
+            instrument.reset()
+            ratelimit.reset()
+            self.redirect('/stats')
+            return
+        template_values = {
+            'title': 'Stats',
+            'percentiles': instrument.PERCENTILES,
+            'rows': instrument.summary(),
+            'rejections': ratelimit.rejections()
+        }
+        self.response.write(self.render('stats.html', template_values))
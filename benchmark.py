@@ -0,0 +1,392 @@
+"""Local load test of question.application.
+
+Runs the WSGI application in-process on top of the App Engine testbed
+stubs (datastore, memcache, users, mail, blobstore, task queue, search,
+images), seeds a synthetic forum and drives every route of the
+application, a vote storm and the task queue handlers the writes enqueue.
+Reports req/s and p50/p99 per route and can save the results as a
+baseline to compare later runs against:
+
+    python benchmark.py --sdk ~/google-cloud-sdk/platform/google_appengine \\
+        --questions 200 --answers 10 --votes 20 --save baseline.json
+    python benchmark.py --sdk ... --compare baseline.json
+
+--dump writes the seeded forum as a bulkdata export and --load seeds a
+later run from one, so runs can share one dataset.
+
+The process starts cold, so the report also carries the import time of
+question.py and the first request of every scenario, which pays for the
+handler module and template loading. --warmup runs /_ah/warmup first,
+as App Engine does before sending a new instance traffic.
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import random
+import re
+import time
+import urllib
+
+import bulkdata
+
+HOST = 'localhost:8080'
+WORDS = ('python performance datastore cache index query answer vote tag image '
+         'thread request latency template render cursor shard memcache search').split()
+
+
+class Bench(object):
+    """ the application on testbed stubs plus the measurements of a run """
+
+    def __init__(self, seed):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+
+        self.random = random.Random(seed)
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(http_host=HOST, overwrite=True)
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_user_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_blobstore_stub()
+        self.testbed.init_images_stub()
+        self.testbed.init_search_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(__file__)))
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.blobstore = self.testbed.get_stub(testbed.BLOBSTORE_SERVICE_NAME)
+
+        os.environ['MAIL_TRANSPORT'] = 'local'
+        start = time.time()
+        import question
+        self.importTime = time.time() - start
+        self.question = question
+        self.timings = {} #scenario -> list of seconds
+        self.firstTimes = {} #scenario -> seconds of its first request in this process
+        self.paths = set() #paths requested, for the coverage check
+
+    def close(self):
+        self.testbed.deactivate()
+
+    def signIn(self, userId, admin=False):
+        if userId is None:
+            self.testbed.setup_env(user_email='', user_id='', user_is_admin='0', overwrite=True)
+        else:
+            self.testbed.setup_env(user_email='user%s@example.com' % userId, user_id=str(userId),
+                                   user_is_admin='1' if admin else '0', overwrite=True)
+
+    def call(self, method, path, params=None, headers=None, body=None):
+        """ run one request through the application, returns the response """
+        import webob
+        self.paths.add(path.split('?', 1)[0])
+        if method == 'GET' and params:
+            path = path + ('&' if '?' in path else '?') + urllib.urlencode(params)
+            params = None
+        request = webob.Request.blank(path, environ={'REQUEST_METHOD': method, 'HTTP_HOST': HOST},
+                                      POST=params, headers=headers or {})
+        if body is not None:
+            request.body = body
+        return request.get_response(self.question.application)
+
+    def timed(self, scenario, method, path, params=None, headers=None):
+        start = time.time()
+        response = self.call(method, path, params, headers)
+        elapsed = time.time() - start
+        self.timings.setdefault(scenario, []).append(elapsed)
+        self.firstTimes.setdefault(scenario, elapsed)
+        if response.status_int >= 500:
+            raise RuntimeError('%s %s failed: %s' % (method, path, response.status))
+        return response
+
+    def drainTasks(self, measure=True):
+        """ run every queued task, and the tasks those enqueue, through the app """
+        while True:
+            tasks = self.taskqueue.get_filtered_tasks()
+            if not tasks:
+                return
+            #the stub's task objects do not carry their queue name
+            for queue in self.taskqueue.GetQueues():
+                self.taskqueue.FlushQueue(queue['name'])
+            #tasks run with no user, as on the queue
+            self.signIn(None)
+            for task in tasks:
+                headers = {'X-AppEngine-TaskName': task.name,
+                           'Content-Type': 'application/x-www-form-urlencoded'}
+                start = time.time()
+                self.call(task.method, task.url, headers=headers, body=task.payload or '')
+                if measure:
+                    scenario = 'task ' + task.url.split('?', 1)[0]
+                    self.timings.setdefault(scenario, []).append(time.time() - start)
+
+    def seed(self, questions, answers, votes, tags, users, legacy=0):
+        """ write a synthetic forum straight through the models, the first
+            legacy questions in the site entity group they used to share """
+        from google.appengine.api import users as gaeusers
+        from google.appengine.ext import ndb
+        q = self.question
+        people = [gaeusers.User('user%d@example.com' % i, _user_id=str(i)) for i in range(users)]
+        tagNames = ['tag%d' % i for i in range(tags)]
+        now = datetime.datetime.now()
+        for i in range(questions):
+            author = self.random.choice(people)
+            if i < legacy:
+                question = q.Question(parent=q.site_key())
+            else:
+                question = q.Question()
+            question.author = author
+            question.handle = 'Question %d about %s' % (i, self.random.choice(WORDS))
+            question.content = self.text(80)
+            q.renderContent(question, HOST)
+            question.tags = self.random.sample(tagNames, min(3, len(tagNames)))
+            question.voteResult = 0
+            question.modifyTime = now - datetime.timedelta(minutes=i)
+            question.lastActivity = question.modifyTime
+            question.answerCount = answers
+            question.put()
+            batch = []
+            for j in range(answers):
+                answer = q.Answer(parent=question.key)
+                answer.author = self.random.choice(people)
+                answer.content = self.text(40)
+                q.renderContent(answer, HOST)
+                answer.voteResult = 0
+                answer.modifyTime = question.modifyTime
+                batch.append(answer)
+            ndb.put_multi(batch)
+            voteBatch = []
+            for voter in self.random.sample(people, min(votes, len(people))):
+                target = self.random.choice([question] + batch)
+                vote = q.Vote(key=q.vote_key(voter, target.key))
+                vote.author = voter
+                vote.value = self.random.choice(['Up', 'Down'])
+                vote.target = target.key
+                vote.question = question.key
+                vote.voteType = target is question
+                target.voteResult += 1 if vote.value == 'Up' else -1
+                voteBatch.append(vote)
+            ndb.put_multi(voteBatch + [question] + batch)
+        self.people = people
+        self.tagNames = tagNames
+        self.prepare()
+
+    def load(self, path, users):
+        """ seed from a bulkdata export instead of a synthetic forum """
+        from google.appengine.api import users as gaeusers
+        count = bulkdata.importFile(path, restart=True, log=lambda message: None)
+        self.people = [gaeusers.User('user%d@example.com' % i, _user_id=str(i)) for i in range(users)]
+        self.prepare()
+        self.tagNames = [key.id() for key in self.question.Tag.query(
+            ancestor=self.question.site_key()).fetch(keys_only=True)]
+        return count
+
+    def cron(self, path):
+        """ run a cron job the way cron calls it, signed out with the cron header """
+        self.signIn(None)
+        response = self.timed('cron ' + path, 'GET', path, headers={'X-AppEngine-Cron': 'true'})
+        if response.status_int != 200:
+            raise RuntimeError('cron %s failed: %s' % (path, response.status))
+
+    def warmup(self):
+        self.timed('GET /_ah/warmup', 'GET', '/_ah/warmup')
+
+    def prepare(self):
+        self.blobKey = 'benchblob'
+        #a 1x1 gif, the images stub opens it with PIL
+        self.blobstore.CreateBlob(self.blobKey, 'GIF89a\x01\x00\x01\x00\x80\x00\x00\xff\xff\xff\x00\x00\x00'
+                                  '!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00'
+                                  '\x02\x02D\x01\x00;')
+        #derived data goes through the application's own repair jobs
+        self.cron('/admin/rebuildtags')
+        self.signIn('admin', admin=True)
+        self.call('GET', '/admin/search/rebuild')
+        self.drainTasks(measure=False)
+        self.timings = {}
+
+    def text(self, words):
+        return ' '.join(self.random.choice(WORDS) for i in range(words))
+
+    def questionKeys(self):
+        return self.question.Question.query().fetch(keys_only=True)
+
+    def run(self, rounds, storm):
+        keys = self.questionKeys()
+        for i in range(rounds):
+            qid = self.random.choice(keys).urlsafe()
+            answer = self.question.Answer.query(ancestor=self.question.ndb.Key(urlsafe=qid)).get()
+            tag = self.random.choice(self.tagNames)
+            user = self.random.randrange(len(self.people))
+
+            self.signIn(None)
+            self.timed('GET / anonymous', 'GET', '/')
+            response = self.timed('GET /list?tag anonymous', 'GET', '/list', {'tag': tag})
+            self.timed('GET /list?tag revalidate', 'GET', '/list', {'tag': tag},
+                       {'If-None-Match': response.headers['ETag']})
+            response = self.timed('GET /view anonymous', 'GET', '/view', {'qid': qid})
+            self.timed('GET /view revalidate', 'GET', '/view', {'qid': qid},
+                       {'If-None-Match': response.headers['ETag']})
+            self.timed('GET /rss', 'GET', '/rss')
+            self.timed('GET /rss?qid', 'GET', '/rss', {'qid': qid})
+            self.timed('GET /tags', 'GET', '/tags')
+            self.timed('GET /search', 'GET', '/search', {'q': self.random.choice(WORDS)})
+            self.timed('GET /image', 'GET', '/image')
+            self.timed('GET /img', 'GET', '/img/' + self.blobKey)
+            self.timed('GET /img/thumb', 'GET', '/img/%s/thumb' % self.blobKey)
+            self.timed('GET /redirect', 'GET', '/redirect', {'arg': 'tags'})
+
+            self.signIn(user)
+            self.timed('GET /', 'GET', '/')
+            self.timed('GET /list?order=active', 'GET', '/list', {'order': 'active'})
+            self.timed('GET /view', 'GET', '/view', {'qid': qid})
+            self.timed('GET /create', 'GET', '/create')
+            response = self.timed('POST /question', 'POST', '/question', {
+                'qhandle': 'Bench question %d' % i, 'qcontent': self.text(60),
+                'tag': ' '.join(self.random.sample(self.tagNames, min(2, len(self.tagNames))))})
+            newQid = response.location.split('qid=', 1)[1]
+            self.timed('GET /create?qid', 'GET', '/create', {'qid': newQid})
+            self.timed('POST /editq', 'POST', '/editq?qid=' + newQid, {
+                'qhandle': 'Bench question %d edited' % i, 'qcontent': self.text(60), 'tag': tag})
+            response = self.timed('POST /answer', 'POST', '/answer?qid=' + newQid, {'acontent': self.text(30)})
+            newAnswer = self.question.Answer.query(
+                ancestor=self.question.ndb.Key(urlsafe=newQid)).get(keys_only=True).urlsafe()
+            self.timed('GET /view?aid', 'GET', '/view', {'aid': newAnswer})
+            self.timed('POST /edita', 'POST', '/edita?aid=' + newAnswer, {'acontent': self.text(30)})
+            if answer:
+                self.timed('POST /vote', 'POST', '/vote?aid=' + answer.key.urlsafe(),
+                           {'value': self.random.choice(['Up', 'Down'])})
+            self.timed('POST /vote', 'POST', '/vote?qid=' + qid, {'value': self.random.choice(['Up', 'Down'])})
+            #the answer's notification and digest run before the answer is deleted
+            self.drainTasks()
+
+            self.signIn('admin', admin=True)
+            self.timed('POST /delete', 'POST', '/delete?aid=' + newAnswer)
+            self.timed('POST /delete', 'POST', '/delete?qid=' + newQid)
+            self.drainTasks()
+        self.signIn('admin', admin=True)
+        self.timed('GET /stats', 'GET', '/stats')
+        for job in ('/admin/migratevotes',
+                    '/admin/migratequestions', '/admin/renderbackfill', '/admin/summarybackfill',
+                    '/admin/search/rebuild'):
+            response = self.timed('GET ' + job, 'GET', job)
+            if response.status_int != 200:
+                raise RuntimeError('GET %s failed: %s' % (job, response.status))
+        self.cron('/admin/rebuildtags')
+        self.cron('/admin/aggregatevotes')
+        self.drainTasks()
+        self.warmup()
+
+        #vote storm: every user votes on the same question as fast as possible
+        target = keys[0].urlsafe()
+        start = time.time()
+        for i in range(storm):
+            self.signIn(i % len(self.people))
+            self.timed('vote storm', 'POST', '/vote?qid=' + target,
+                       {'value': self.random.choice(['Up', 'Down'])})
+        stormTime = time.time() - start
+        self.drainTasks()
+        return stormTime
+
+    def report(self):
+        """ per scenario count, req/s, p50 and p99 in ms """
+        from instrument import percentile
+        results = {}
+        for scenario, times in self.timings.items():
+            times = sorted(times)
+            results[scenario] = {
+                'count': len(times),
+                'rps': len(times) / sum(times) if sum(times) else 0,
+                'p50': percentile(times, 50) * 1000,
+                'p99': percentile(times, 99) * 1000,
+            }
+        #cold start, one sample each
+        cold = dict(('first ' + scenario, seconds) for scenario, seconds in self.firstTimes.items()
+                    if scenario.startswith('GET ') or scenario.startswith('POST '))
+        cold['import question'] = self.importTime
+        for scenario, seconds in cold.items():
+            results[scenario] = {'count': 1, 'rps': 1 / seconds if seconds else 0,
+                                 'p50': seconds * 1000, 'p99': seconds * 1000}
+        return results
+
+    def uncoveredRoutes(self):
+        """ routes of the application this run never exercised """
+        import question
+        routes = [route.template for route in question.app.router.match_routes]
+        return [route for route in routes
+                if not any(re.match(route + '$', path) for path in self.paths)]
+
+
+def printReport(results, baseline=None):
+    print('%-32s %7s %9s %9s %9s' % ('scenario', 'count', 'req/s', 'p50 ms', 'p99 ms'))
+    for scenario in sorted(results):
+        row = results[scenario]
+        line = '%-32s %7d %9.1f %9.1f %9.1f' % (scenario, row['count'], row['rps'], row['p50'], row['p99'])
+        if baseline and scenario in baseline:
+            base = baseline[scenario]
+            line += '   p50 %+.0f%%  p99 %+.0f%%' % (
+                100.0 * (row['p50'] - base['p50']) / (base['p50'] or 1),
+                100.0 * (row['p99'] - base['p99']) / (base['p99'] or 1))
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sdk', help='App Engine SDK directory, default $GAE_SDK')
+    parser.add_argument('--questions', type=int, default=100)
+    parser.add_argument('--answers', type=int, default=5, help='answers per question')
+    parser.add_argument('--votes', type=int, default=10, help='votes per question thread')
+    parser.add_argument('--tags', type=int, default=20)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--legacy', type=int, default=0,
+                        help='questions seeded in the old shared entity group, moved during the run')
+    parser.add_argument('--rounds', type=int, default=20, help='passes over the routes')
+    parser.add_argument('--storm', type=int, default=200, help='votes in the vote storm')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--load', help='seed from this bulkdata export file')
+    parser.add_argument('--dump', help='export the seeded forum to this file before the run')
+    parser.add_argument('--warmup', action='store_true', help='request /_ah/warmup before the run')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    args = parser.parse_args()
+
+    bulkdata.setupSdk(args.sdk)
+    bench = Bench(args.seed)
+    try:
+        if args.warmup:
+            bench.warmup()
+        start = time.time()
+        if args.load:
+            count = bench.load(args.load, args.users)
+            print('loaded %d entities in %.1fs' % (count, time.time() - start))
+        else:
+            bench.seed(args.questions, args.answers, args.votes, args.tags, args.users, args.legacy)
+            print('seeded %d questions in %.1fs' % (args.questions, time.time() - start))
+        if args.dump:
+                bulkdata.export(args.dump, restart=True, log=lambda message: None)
+        stormTime = bench.run(args.rounds, args.storm)
+        results = bench.report()
+        baseline = None
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)['results']
+        printReport(results, baseline)
+        if args.storm:
+            print('vote storm: %d votes in %.1fs, %.1f votes/s' % (args.storm, stormTime, args.storm / stormTime))
+        import ratelimit
+        for name, count in ratelimit.rejections():
+            print('rate limit %s rejected %d requests' % (name, count))
+        uncovered = bench.uncoveredRoutes()
+        if uncovered:
+            print('routes not exercised: %s' % ', '.join(uncovered))
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump({'args': vars(args), 'results': results}, f, indent=1, sort_keys=True)
+    finally:
+        bench.close()
+
+
+if __name__ == '__main__':
+    main()
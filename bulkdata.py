@@ -0,0 +1,262 @@
+"""Bulk export and import of the forum's questions, answers and votes.
+
+The export file is a sequence of gzip members, so zcat reads it as a
+whole, one member per chunk of up to --batch entities. Every line of a
+chunk is one entity as compact JSON, [key path, {property: value}], and
+the last line of a chunk is '#<number of entities>' so a chunk cut short
+by an interruption is recognised. Keys are stored as paths rather than
+urlsafe strings, so a file exported from one application imports into
+another.
+
+Both directions page through the data one chunk at a time and record
+their position in <file>.progress after every chunk. A run that stops
+resumes from the last complete chunk, and the file is deleted once the
+run finishes. Memory use therefore stays the same whatever the size of
+the forum. Importing a chunk twice writes the same entities again, so
+resuming is always safe.
+
+Derived data is not exported: after an import run /admin/rebuildtags and
+/admin/search/rebuild. Run /admin/aggregatevotes before an export so
+pending vote shards are folded into voteResult.
+
+    python bulkdata.py export forum.gz --sdk ~/google-cloud-sdk/platform/google_appengine \\
+        --host ray-ost-question.appspot.com
+    python bulkdata.py import forum.gz --sdk ... --host localhost:8080
+
+benchmark.py --load seeds its load test from such a file.
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import zlib
+
+KINDS = ('Question', 'Answer', 'Vote') #models of question.py, in export order
+BATCH = 200 #entities per chunk, one fetch_page or put_multi each
+READ_SIZE = 64 * 1024
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def setupSdk(sdk):
+    """ put the App Engine SDK and its bundled libraries on sys.path """
+    sdk = sdk or os.environ.get('GAE_SDK')
+    if sdk:
+        sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+def connect(host):
+    """ send the datastore calls of this process to host's remote_api """
+    from google.appengine.ext.remote_api import remote_api_stub
+    remote_api_stub.ConfigureRemoteApiForOAuth(host, '/_ah/remote_api')
+
+
+def encodeValue(prop, value):
+    from google.appengine.ext import ndb
+    if value is None:
+        return None
+    if isinstance(prop, ndb.KeyProperty):
+        return list(value.flat())
+    if isinstance(prop, ndb.UserProperty):
+        return [value.email(), value.user_id()]
+    if isinstance(prop, ndb.DateTimeProperty):
+        return value.strftime(TIME_FORMAT)
+    return value
+
+
+def decodeValue(prop, value):
+    from google.appengine.api import users
+    from google.appengine.ext import ndb
+    if value is None:
+        return None
+    if isinstance(prop, ndb.KeyProperty):
+        return ndb.Key(flat=value)
+    if isinstance(prop, ndb.UserProperty):
+        return users.User(value[0], _user_id=value[1])
+    if isinstance(prop, ndb.DateTimeProperty):
+        return datetime.datetime.strptime(value, TIME_FORMAT)
+    return value
+
+
+def encodeEntity(entity):
+    """ one line of the export file """
+    values = {}
+    for name, prop in entity._properties.items():
+        value = prop._get_value(entity)
+        if prop._repeated:
+            values[name] = [encodeValue(prop, item) for item in value]
+        else:
+            values[name] = encodeValue(prop, value)
+    return json.dumps([list(entity.key.flat()), values], separators=(',', ':'), sort_keys=True)
+
+
+def decodeEntity(line):
+    """ the entity of one line, properties the model no longer has are dropped """
+    from google.appengine.ext import ndb
+    import question
+    path, values = json.loads(line)
+    key = ndb.Key(flat=path)
+    model = ndb.Model._lookup_model(key.kind())
+    entity = model(key=key)
+    for name, value in values.items():
+        prop = model._properties.get(name)
+        if prop is None:
+            continue
+        if prop._repeated:
+            prop._set_value(entity, [decodeValue(prop, item) for item in value])
+        else:
+            prop._set_value(entity, decodeValue(prop, value))
+    if isinstance(entity, question.Vote):
+        #vote ids embed the target's urlsafe key, which names the application
+        entity.key = question.vote_key(entity.author, entity.target)
+    return entity
+
+
+def compressChunk(lines):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    text = '\n'.join(lines + ['#%d' % len(lines)]) + '\n'
+    return compressor.compress(text.encode('utf-8')) + compressor.flush()
+
+
+def readChunks(f, offset=0):
+    """ yields (lines, file offset after the chunk) of every chunk from offset on """
+    f.seek(offset)
+    data = f.read(READ_SIZE)
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        parts = []
+        while True:
+            parts.append(decompressor.decompress(data))
+            if decompressor.unused_data:
+                rest = decompressor.unused_data
+                offset += len(data) - len(rest)
+                data = rest
+                break
+            offset += len(data)
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+        parts.append(decompressor.flush())
+        lines = b''.join(parts).decode('utf-8').split('\n')
+        if len(lines) < 2 or lines[-1] or lines[-2] != '#%d' % (len(lines) - 2):
+            raise ValueError('incomplete chunk before offset %d' % offset)
+        yield lines[:-2], offset
+
+
+def loadProgress(path):
+    try:
+        with open(path + '.progress') as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+def saveProgress(path, progress):
+    with open(path + '.progress.tmp', 'w') as f:
+        json.dump(progress, f)
+    os.rename(path + '.progress.tmp', path + '.progress')
+
+
+def export(path, batch=BATCH, restart=False, log=print):
+    """ write every question, answer and vote to path, returns the count """
+    from google.appengine.datastore.datastore_query import Cursor
+    import question
+    progress = None if restart else loadProgress(path)
+    if progress:
+        #a chunk written after the last saved position is incomplete
+        f = open(path, 'r+b')
+        f.seek(progress['offset'])
+        f.truncate()
+        log('resuming %s at %s' % (path, progress['kind'] or 'the end'))
+    else:
+        f = open(path, 'wb')
+        progress = {'offset': 0, 'kind': KINDS[0], 'cursor': None, 'count': 0}
+    if progress['kind']:
+        start = KINDS.index(progress['kind'])
+    else:
+        start = len(KINDS)
+    with f:
+        for i in range(start, len(KINDS)):
+            kind = KINDS[i]
+            #every thread and every voter is its own entity group
+            query = getattr(question, kind).query()
+            curs = Cursor(urlsafe=progress['cursor']) if progress['cursor'] else None
+            future = query.fetch_page_async(batch, start_cursor=curs, use_cache=False)
+            while future:
+                entities, curs, more = future.get_result()
+                #the next page is fetched while this one is written
+                if more and curs:
+                    future = query.fetch_page_async(batch, start_cursor=curs, use_cache=False)
+                else:
+                    future = None
+                if entities:
+                    f.write(compressChunk([encodeEntity(entity) for entity in entities]))
+                    f.flush()
+                    os.fsync(f.fileno())
+                progress = {'offset': f.tell(), 'kind': kind, 'cursor': None,
+                            'count': progress['count'] + len(entities)}
+                if future:
+                    progress['cursor'] = curs.urlsafe()
+                elif i + 1 < len(KINDS):
+                    progress['kind'] = KINDS[i + 1]
+                else:
+                    progress['kind'] = None
+                saveProgress(path, progress)
+            log('%s exported, %d entities so far' % (kind, progress['count']))
+    os.remove(path + '.progress')
+    return progress['count']
+
+
+def importFile(path, restart=False, log=print):
+    """ write every entity of path to the datastore, returns the count """
+    from google.appengine.ext import ndb
+    progress = None if restart else loadProgress(path)
+    if progress:
+        log('resuming %s at offset %d' % (path, progress['offset']))
+    else:
+        progress = {'offset': 0, 'count': 0}
+    pending = None
+    with open(path, 'rb') as f:
+        for lines, offset in readChunks(f, progress['offset']):
+            entities = [decodeEntity(line) for line in lines]
+            #the next chunk is decoded while this one is written
+            futures = ndb.put_multi_async(entities, use_cache=False)
+            if pending:
+                for future in pending[0]:
+                    future.check_success()
+                saveProgress(path, pending[1])
+            progress = {'offset': offset, 'count': progress['count'] + len(entities)}
+            pending = (futures, progress)
+    if pending:
+        for future in pending[0]:
+            future.check_success()
+    if os.path.exists(path + '.progress'):
+        os.remove(path + '.progress')
+    return progress['count']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('path', help='export file')
+    parser.add_argument('--sdk', help='App Engine SDK directory, default $GAE_SDK')
+    parser.add_argument('--host', required=True, help='application serving /_ah/remote_api')
+    parser.add_argument('--batch', type=int, default=BATCH, help='entities per chunk')
+    parser.add_argument('--restart', action='store_true', help='ignore an interrupted run')
+    args = parser.parse_args()
+
+    setupSdk(args.sdk)
+    connect(args.host)
+    if args.command == 'export':
+        count = export(args.path, args.batch, args.restart)
+    else:
+        count = importFile(args.path, args.restart)
+    print('%d entities %sed' % (count, args.command))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Image upload, the image gallery and serving of images and their
+derivatives.
+
+Only these routes need the blobstore handlers, the router imports this
+module on the first request to one of them, see question.py.
+"""
+import urllib
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import blobstore
+from google.appengine.ext.webapp import blobstore_handlers
+
+from question import (BaseHandler, deriveImage, getImageVariant, IMAGE_MAX_AGE,
+                      IMAGE_VARIANTS, IMAGES_PER_PAGE, JobHandler)
+
+
+class GetImagesPage(BaseHandler):
+    """  This is a page show all the images """
+    def get(self):
+        upload_url = blobstore.create_upload_url('/uploadImage')
+
+        images_query = blobstore.BlobInfo.all().order('-creation')
+        if self.request.get('cursor'):
+            try:
+                images_query.with_cursor(self.request.get('cursor'))
+            except:
+                self.redirect('/image')
+                return
+        images = images_query.fetch(IMAGES_PER_PAGE)
+        if len(images) == IMAGES_PER_PAGE:
+            nextPageUrl = '/image?' + urllib.urlencode({'cursor': images_query.cursor()})
+        else:
+            nextPageUrl = None
+        template_values = {
+            'title':'Images',
+            'images':images,
+            'nextPageUrl': nextPageUrl,
+            'uploadUrl':upload_url
+        }
+
+        self.response.write(self.render('images.html', template_values))
+
+class ImageHandler(blobstore_handlers.BlobstoreDownloadHandler):
+    """ serve an uploaded image, or with a variant one of its derivatives """
+    def get(self, resource, variant=None):
+        resource = str(urllib.unquote(resource))
+        self.response.headers['Cache-Control'] = 'public, max-age=%d' % IMAGE_MAX_AGE
+        if variant:
+            self.response.etag = '%s/%s' % (resource, variant)
+        else:
+            self.response.etag = resource
+        if self.response.etag in self.request.if_none_match:
+            self.response.set_status(304)
+            return
+        if variant:
+            if variant not in IMAGE_VARIANTS:
+                self.abort(404)
+            image = getImageVariant(resource, variant)
+            if image is None:
+                self.abort(404)
+            self.response.headers['Content-Type'] = image.contentType
+            self.response.write(image.data)
+            return
+        blob_info = blobstore.BlobInfo.get(resource)
+        if blob_info is None:
+            self.abort(404)
+        self.send_blob(blob_info)
+
+class UploadImageHandler(blobstore_handlers.BlobstoreUploadHandler):
+    def post(self):
+        for blob_info in self.get_uploads('image'):
+            taskqueue.add(url='/admin/images/derive', params={'blob': str(blob_info.key())})
+        self.redirect('/redirect?arg=image') 
+
+class DeriveImages(JobHandler):
+    """ task creating every derivative of a freshly uploaded image """
+    def post(self):
+        for variant in IMAGE_VARIANTS:
+            deriveImage(self.request.get('blob'), variant)
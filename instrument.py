@@ -0,0 +1,182 @@
+"""Hot path instrumentation.
+
+Instrument wraps the WSGI application and records for every request the
+route and handler class, total latency, datastore RPC count and time,
+template render time and response size. Each request can be logged as one
+JSON line (INSTRUMENT_LOG in app.yaml) and the latest samples of every
+route are kept per instance for the percentiles on the /stats page.
+"""
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+import jinja2
+
+import rpctimeline
+
+SAMPLES_PER_ROUTE = 1000
+PERCENTILES = (50, 90, 99)
+
+_local = threading.local()
+_lock = threading.Lock()
+_samples = {} #(route, handler) -> deque of Sample
+
+
+class Sample(object):
+    """ the measurements of one request """
+    __slots__ = ('route', 'handler', 'status', 'latency', 'rpcCount', 'rpcTime',
+                 'datastoreCount', 'datastoreTime', 'renderTime', 'size')
+
+    def __init__(self):
+        self.route = None
+        self.handler = None
+        self.status = None
+        self.renderTime = 0.0
+        self.size = 0
+
+    def asDict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+def current():
+    """ the sample of the request running on this thread, or None """
+    return getattr(_local, 'sample', None)
+
+
+def dispatcher(router, request, response):
+    """ webapp2 dispatcher noting which route and handler serve the request """
+    sample = current()
+    if sample is not None and request.route is not None:
+        sample.route = getattr(request.route, 'template', None) or request.route.name
+        handler = request.route.handler
+        sample.handler = getattr(handler, '__name__', None) or str(handler)
+    return router.default_dispatcher(request, response)
+
+
+class TimedTemplate(jinja2.Template):
+    """ template class adding its render time to the current sample """
+
+    def render(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return jinja2.Template.render(self, *args, **kwargs)
+        finally:
+            addRenderTime(time.time() - start)
+
+
+def addRenderTime(seconds):
+    sample = current()
+    if sample is not None:
+        sample.renderTime += seconds
+
+
+def record(sample):
+    key = (sample.route or '-', sample.handler or '-')
+    with _lock:
+        samples = _samples.get(key)
+        if samples is None:
+            samples = _samples[key] = collections.deque(maxlen=SAMPLES_PER_ROUTE)
+        samples.append(sample)
+
+
+def percentile(values, p):
+    """ the p-th percentile of a sorted list, nearest rank """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def summary():
+    """ per route statistics, a list of dicts sorted by route """
+    with _lock:
+        groups = [(key, list(samples)) for key, samples in _samples.items()]
+    rows = []
+    for (route, handler), samples in sorted(groups):
+        latencies = sorted(sample.latency for sample in samples)
+        datastoreTimes = sorted(sample.datastoreTime for sample in samples)
+        renderTimes = sorted(sample.renderTime for sample in samples)
+        rows.append({
+            'route': route,
+            'handler': handler,
+            'count': len(samples),
+            'latency': [percentile(latencies, p) * 1000 for p in PERCENTILES],
+            'datastoreTime': [percentile(datastoreTimes, p) * 1000 for p in PERCENTILES],
+            'renderTime': [percentile(renderTimes, p) * 1000 for p in PERCENTILES],
+            'datastoreCount': sum(sample.datastoreCount for sample in samples) / float(len(samples)),
+            'size': sum(sample.size for sample in samples) / float(len(samples)),
+        })
+    return rows
+
+
+def reset():
+    with _lock:
+        _samples.clear()
+
+
+class Instrument(object):
+    """ WSGI middleware measuring every request """
+
+    def __init__(self, app, log=None, logTimeline=None):
+        self.app = app
+        if log is None:
+            log = os.environ.get('INSTRUMENT_LOG') == 'true'
+        if logTimeline is None:
+            logTimeline = os.environ.get('RPC_TIMELINE') == 'true'
+        self.log = log
+        self.logTimeline = logTimeline
+
+    def __call__(self, environ, start_response):
+        sample = Sample()
+        _local.sample = sample
+        timeline = rpctimeline.begin()
+
+        def startResponse(status, headers, exc_info=None):
+            sample.status = int(status.split(' ', 1)[0])
+            return start_response(status, headers, exc_info)
+
+        try:
+            body = self.app(environ, startResponse)
+        except:
+            self.finish(environ, sample, timeline)
+            raise
+        if isinstance(body, (list, tuple)):
+            sample.size = sum(len(chunk) for chunk in body)
+            self.finish(environ, sample, timeline)
+            return body
+        #a streamed body is measured once the server has consumed it
+        rpctimeline.end()
+        _local.sample = None
+        return self.stream(environ, body, sample, timeline)
+
+    def stream(self, environ, body, sample, timeline):
+        _local.sample = sample
+        try:
+            for chunk in body:
+                sample.size += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            self.finish(environ, sample, timeline)
+
+    def finish(self, environ, sample, timeline):
+        rpctimeline.end()
+        _local.sample = None
+        sample.latency = time.time() - timeline.start
+        datastore = [span for span in timeline.spans if span[0].startswith('datastore_v3.')]
+        sample.rpcCount = len(timeline.spans)
+        sample.rpcTime = timeline.rpcTime()
+        sample.datastoreCount = len(datastore)
+        sample.datastoreTime = sum(duration for name, offset, duration in datastore)
+        record(sample)
+        if self.log:
+            logging.info('request %s', json.dumps(dict(sample.asDict(),
+                         method=environ.get('REQUEST_METHOD'), path=environ.get('PATH_INFO'))))
+        if self.logTimeline:
+            logging.info('RPC timeline %s %s: %d rpcs, %dms waiting, %dms wall: %s',
+                         environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'),
+                         sample.rpcCount, sample.rpcTime * 1000, sample.latency * 1000,
+                         timeline.format())
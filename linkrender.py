@@ -0,0 +1,63 @@
+"""Link and image rewriting for question and answer bodies.
+
+Bodies are rendered once when they are written and the HTML is stored next
+to the raw content, so list and view pages do no regex work per request.
+"""
+import os
+import re
+
+LINK_RE = re.compile(r'(https?://([^ ,;\n]*))')
+IMAGE_SUFFIXES = ('.jpg', '.png', '.gif')
+EXCERPT_LENGTH = 500 #characters of a question shown on the main page
+
+
+class LinkRenderer(object):
+    """ turn bare urls into links, and image urls into <img> tags carrying
+        imageAttrs, uploaded images point at their uploadVariant if given """
+
+    def __init__(self, imageAttrs='', uploadVariant=None):
+        self.imageTemplate = '<img src="%s"' + imageAttrs + '>'
+        self.uploadVariant = uploadVariant
+
+    def render(self, s, host=None):
+        """ rewrite the links of s, uploaded images are recognised by host """
+        imagePrefix = 'http://' + (host or os.environ['HTTP_HOST']) + '/img'
+        imageTemplate = self.imageTemplate
+        uploadVariant = self.uploadVariant
+
+        def replink(m):
+            url = m.group()
+            if url.startswith(imagePrefix):
+                #only a plain /img/<blob key> url has derivatives
+                if uploadVariant and url.count('/', len(imagePrefix)) == 1:
+                    url = url + '/' + uploadVariant
+                return imageTemplate % url
+            if url.endswith(IMAGE_SUFFIXES):
+                return imageTemplate % url
+            return '<a href="' + m.group(1) + '">' + m.group(2) + '</a>'
+        return LINK_RE.sub(replink, s)
+
+
+FULL = LinkRenderer()
+THUMBNAIL = LinkRenderer(' height="50" width="50"', uploadVariant='thumb')
+
+
+def truncate(s, length=EXCERPT_LENGTH, end='...'):
+    """ cut s on a word boundary, same as jinja's truncate(length, false) """
+    if len(s) <= length:
+        return s
+    words = s.split(' ')
+    result = []
+    m = 0
+    for word in words:
+        m += len(word) + 1
+        if m > length:
+            break
+        result.append(word)
+    result.append(end)
+    return u' '.join(result)
+
+
+def renderExcerpt(s, host=None):
+    """ the truncated, thumbnail sized rendering used on list pages """
+    return THUMBNAIL.render(truncate(s), host)
@@ -0,0 +1,73 @@
+"""Answer notification mail.
+
+Handlers never send mail themselves; answers are collected into one digest
+per question author and time window by the task queue, and the digest is
+handed to a transport. MailTransport sends through the mail API,
+LocalTransport keeps messages in memory for tests and the dev server.
+"""
+import os
+
+SENDER = "Admin <wl1002@nyu.edu>"
+
+
+class MailTransport(object):
+    """ send through the App Engine mail API """
+
+    def send(self, recipient, subject, body):
+        from google.appengine.api import mail
+        if not mail.is_email_valid(recipient.email()):
+            return False
+        message = mail.EmailMessage(sender=SENDER, subject=subject)
+        message.to = "%s <%s>" % (recipient.nickname(), recipient.email())
+        message.body = body
+        message.send()
+        return True
+
+
+class LocalTransport(object):
+    """ keep messages in outbox instead of sending them """
+
+    def __init__(self):
+        self.outbox = []
+
+    def send(self, recipient, subject, body):
+        self.outbox.append((recipient, subject, body))
+        return True
+
+
+def getTransport():
+    """ the transport chosen by MAIL_TRANSPORT in app.yaml """
+    if os.environ.get('MAIL_TRANSPORT') == 'local':
+        return LOCAL_TRANSPORT
+    return MailTransport()
+
+LOCAL_TRANSPORT = LocalTransport()
+
+
+def composeDigest(recipient, answers):
+    """ subject and body of one mail covering all answers, a list of
+        (answer content, answer author) pairs """
+    if len(answers) == 1:
+        subject = "Your question receives a new answer"
+        intro = "Your question has received a new answer:"
+    else:
+        subject = "Your questions receive %d new answers" % len(answers)
+        intro = "Your questions have received %d new answers:" % len(answers)
+    parts = []
+    for content, author in answers:
+        parts.append("""
+        %s
+
+        By
+
+        %s
+        """ % (content, author.nickname()))
+    body = """
+        Dear %s:
+
+        %s
+        %s
+        Sincerely,
+        Ray Question Team
+        """ % (recipient.nickname(), intro, ''.join(parts))
+    return subject, body
@@ -0,0 +1,99 @@
+"""Rendered page cache.
+
+Pages are cached under a key built from the route and its parameters plus
+the current version of every invalidation group the page depends on, e.g.
+'list' for the main question list or 'view:<question key>' for one thread.
+Invalidating a group just gives it a new version, so every page built on
+the old version stops matching and ages out of the store on its own.
+"""
+import collections
+import threading
+import time
+import uuid
+
+
+class MemoryStore(object):
+    """ in-process LRU store with a per entry time to live """
+
+    def __init__(self, capacity=200):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_multi(self, keys):
+        now = time.time()
+        found = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is None:
+                    continue
+                if entry[0] and entry[0] < now:
+                    continue
+                #re-insert to mark the entry as most recently used
+                self.entries[key] = entry
+                found[key] = entry[1]
+        return found
+
+    def set_multi(self, mapping, ttl=0):
+        expires = time.time() + ttl if ttl else 0
+        with self.lock:
+            for key, value in mapping.items():
+                self.entries.pop(key, None)
+                self.entries[key] = (expires, value)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+
+class MemcacheStore(object):
+    """ store backed by App Engine memcache, shared by every instance """
+
+    def __init__(self, namespace='pagecache'):
+        from google.appengine.api import memcache
+        self.memcache = memcache
+        self.namespace = namespace
+
+    def get_multi(self, keys):
+        return self.memcache.get_multi(keys, namespace=self.namespace)
+
+    def set_multi(self, mapping, ttl=0):
+        self.memcache.set_multi(mapping, time=ttl, namespace=self.namespace)
+
+
+class PageCache(object):
+    """ versioned page cache over a MemoryStore or MemcacheStore """
+
+    def __init__(self, store, ttl=60):
+        self.store = store
+        self.ttl = ttl
+
+    def _versions(self, groups):
+        versionKeys = ['v:' + group for group in groups]
+        versions = self.store.get_multi(versionKeys)
+        #a group without a version gets a fresh one, so a version that was
+        #evicted can never bring an older page back to life
+        missing = dict((key, uuid.uuid4().hex) for key in versionKeys if key not in versions)
+        if missing:
+            self.store.set_multi(missing)
+            versions.update(missing)
+        return [versions[key] for key in versionKeys]
+
+    def _key(self, key, groups):
+        return '|'.join([repr(key)] + self._versions(groups))
+
+    def get(self, key, groups):
+        """ return the cached page for key, or None, and the token to set
+            the page with. The token holds the group versions read here, so
+            a page built after this get goes stale with an invalidation
+            that comes before its set """
+        fullKey = self._key(key, groups)
+        return self.store.get_multi([fullKey]).get(fullKey), fullKey
+
+    def set(self, token, page):
+        """ cache page under the token of the get that missed it """
+        self.store.set_multi({token: page}, self.ttl)
+
+    def invalidate(self, *groups):
+        """ drop every page cached under any of groups """
+        if groups:
+            self.store.set_multi(dict(('v:' + group, uuid.uuid4().hex) for group in groups))
@@ -0,0 +1,396 @@
+"""Pages reading the forum: the question lists, search, the tag index, a
+thread and the RSS feeds.
+"""
+import hashlib
+import os
+import urllib
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import webapp2
+
+import searchindex
+from question import (Answer, ANSWERS_PER_PAGE, BaseHandler, getListItems, getUserVotes,
+                      jinjaEnvironment, LIST_ORDERS, MAX_FILTER_TAGS, PAGE_CACHE,
+                      Question, RSS_ITEMS, site_key, Tag, tag_pair_key,
+                      tag_pairs, TagPair, threadEtag)
+
+
+# [START main_page]
+class MainPage(BaseHandler):
+    """ mainpage to show all questions or qustions by tags, several tags
+        match with all of them (match=all) or any of them (match=any) """
+    def get(self):
+        current_user = self.current_user
+        #tags never contain spaces, so one parameter may carry several
+        tags = sorted(set(tag for value in self.request.get_all('tag') for tag in value.split()))
+        tags = tags[:MAX_FILTER_TAGS]
+        if len(tags) > 1 and self.request.get('match') == 'any':
+            match = 'any'
+        else:
+            match = 'all'
+
+        #anonymous visitors all get the same page
+        if not current_user:
+            cacheKey = ('list', os.environ['HTTP_HOST'], tuple(tags), match,
+                        self.request.get('order'), self.request.get('cursor'))
+            if tags:
+                cacheGroups = ['list:' + tag for tag in tags]
+            else:
+                cacheGroups = ['list']
+            cached, cacheToken = PAGE_CACHE.get(cacheKey, cacheGroups)
+            #every write a list shows gives one of its groups a new version, so
+            #the versions in the token tag the page before any query runs
+            etag = hashlib.md5('%s|%s' % (os.environ.get('CURRENT_VERSION_ID'), cacheToken)).hexdigest()
+            if self.checkEtag(etag):
+                return
+            if cached is not None:
+                self.response.write(cached)
+                return
+
+        # if there are tags, get questions by tags
+        questions_query = Question.query()
+        if match == 'any':
+            questions_query = questions_query.filter(ndb.OR(*[Question.tags == tag for tag in tags]))
+        else:
+            #several equality filters on tags run as a zig-zag merge join
+            #over the single tag index of the chosen ordering
+            for tag in tags:
+                questions_query = questions_query.filter(Question.tags == tag)
+        #every ordering is one indexed query, see index.yaml
+        order = self.request.get('order')
+        if order == 'active':
+            orders = [-Question.lastActivity]
+        elif order == 'top':
+            orders = [-Question.voteResult]
+        elif order == 'unanswered':
+            questions_query = questions_query.filter(Question.answerCount == 0)
+            orders = [-Question.modifyTime]
+        else:
+            order = ''
+            orders = [-Question.modifyTime]
+        if match == 'any':
+            #cursors over merged OR queries need the key as the last order
+            orders.append(Question.key)
+        questions_query = questions_query.order(*orders)
+        
+        #check whether cursor exists
+        if self.request.get('cursor'):
+            try:
+                curs =Cursor(urlsafe=self.request.get('cursor'))
+            except:
+                self.redirect('/')
+                return          
+        else:
+            curs = None
+
+        questions_future = questions_query.fetch_page_async(10, start_cursor=curs, keys_only=True)
+        related_future = None
+        pair_futures = []
+        if tags and match == 'all':
+            #a pair of tags never used together means nothing can match, the
+            #pairs are read alongside the query
+            pair_futures = ndb.get_multi_async([tag_pair_key(*pair) for pair in tag_pairs(tags)])
+            related_future = TagPair.query(TagPair.tags == tags[0], ancestor=site_key()).order(
+                -TagPair.count).fetch_async(10 + len(tags))
+
+        #the login url RPC overlaps the queries
+        self.signUrl
+        keys, next_curs, more = questions_future.get_result()
+        if None in [future.get_result() for future in pair_futures]:
+            keys, next_curs, more = [], None, False
+        #the page needs compact list items, never the questions' content
+        questions = getListItems(keys)
+
+        listParams = {}
+        if tags:
+            listParams['tag'] = ' '.join(tags).encode('utf-8')
+        if match == 'any':
+            listParams['match'] = match
+        orderUrls = []
+        for name, label in LIST_ORDERS:
+            query_params = dict(listParams)
+            if name:
+                query_params['order'] = name
+            orderUrls.append((label, '/list?' + urllib.urlencode(query_params), name == order))
+
+        #tags seen together with the filter, each link narrows it further
+        relatedUrls = []
+        if related_future:
+            for pair in related_future.get_result():
+                other = [tag for tag in pair.tags if tag != tags[0]][0]
+                if other not in tags:
+                    query_params = dict(listParams, tag=' '.join(tags + [other]).encode('utf-8'))
+                    relatedUrls.append((other, '/list?' + urllib.urlencode(query_params)))
+
+        if more and next_curs:
+            query_params = dict(listParams, cursor=next_curs.urlsafe())
+            if order:
+                query_params['order'] = order
+            nextPageUrl =  '/list?' + urllib.urlencode(query_params)
+        else:
+            nextPageUrl=None
+
+        if len(tags) == 1:
+            rssUrl = '/rss?' + urllib.urlencode({'tag': tags[0].encode('utf-8')})
+        else:
+            rssUrl = '/rss'
+        
+        template_values = {
+            'title': 'Question',
+            'questions': questions,
+            'tags': tags,
+            'match': match,
+            'relatedUrls': relatedUrls,
+            'rssUrl': rssUrl,
+            'orderUrls': orderUrls,
+            'nextPageUrl' : nextPageUrl
+        }
+
+        page = self.render('mainPage.html', template_values)
+        if not current_user:
+            PAGE_CACHE.set(cacheToken, page)
+        self.response.write(page)
+# [END main_page]
+
+class SearchPage(BaseHandler):
+    """ full text search over questions and answers """
+    def get(self):
+        q = self.request.get('q')
+        try:
+            ids, next_curs = searchindex.query(searchindex.tokenize(q), self.request.get('cursor'))
+        except (ValueError, searchindex.search.Error):
+            ids, next_curs = [], None
+        questions = getListItems([ndb.Key(urlsafe=qid) for qid in ids])
+        if next_curs:
+            query_params = {'q': q.encode('utf-8'), 'cursor': next_curs}
+            nextPageUrl = '/search?' + urllib.urlencode(query_params)
+        else:
+            nextPageUrl = None
+
+        template_values = {
+            'title': 'Search',
+            'q': q,
+            'questions': questions,
+            'nextPageUrl': nextPageUrl
+        }
+        self.response.write(self.render('search.html', template_values))
+
+class GetTagsPage(BaseHandler):
+    """  This is a page show all the tags """
+    def get(self):
+        #read the maintained tag index instead of scanning every question
+        tags_future = Tag.query(ancestor=site_key()).fetch_async()
+        #the sign url RPC overlaps the query
+        self.signUrl
+        tags = tags_future.get_result()
+        tagsUrl={}
+        for tag in tags:
+            query_params = {'tag': tag.key.id().encode('utf-8')}
+            tagsUrl[tag.key.id()] = ('/list?' + urllib.urlencode(query_params))
+        template_values = {
+            'title':'Tags',
+            'tags':tags,
+            'tagsUrl':tagsUrl
+        }
+
+        self.response.write(self.render('tags.html', template_values))
+
+class ViewQuestion(BaseHandler):
+    """ render view question page """
+    #Add vote view vote handle order by vote
+    def get(self):
+        current_user = self.current_user
+       
+        if self.request.get('qid'):
+            questionKey = self.questionKey
+            if not questionKey:
+                self.redirect('/')
+                return
+            qid = questionKey.urlsafe()
+            if not current_user:
+                cacheKey = ('view', os.environ['HTTP_HOST'], questionKey.urlsafe(), self.request.get('cursor'))
+                cacheGroups = ['view:' + questionKey.urlsafe()]
+                cached, cacheToken = PAGE_CACHE.get(cacheKey, cacheGroups)
+                if cached is not None:
+                    page, etag = cached
+                    if not self.checkEtag(etag):
+                        self.response.write(page)
+                    return
+            answers_query = Answer.query(ancestor=questionKey).order(-Answer.voteResult)
+            if self.request.get('cursor'):
+                try:
+                    curs = Cursor(urlsafe=self.request.get('cursor'))
+                except:
+                    self.redirect('/view?' + urllib.urlencode({'qid': qid}))
+                    return
+            else:
+                curs = None
+            question_future = questionKey.get_async()
+            if not current_user and question_future.get_result():
+                #an unchanged page costs this one key lookup
+                etag = threadEtag(question_future.get_result(), self.request.get('cursor'))
+                if self.checkEtag(etag):
+                    return
+            #for a signed in user the question and its answers are fetched in parallel
+            answers_future = answers_query.fetch_page_async(ANSWERS_PER_PAGE, start_cursor=curs)
+            #the sign url RPC overlaps the datastore ones
+            self.signUrl
+            question = question_future.get_result()
+            answers, next_curs, more = answers_future.get_result()
+            if more and next_curs:
+                query_params = {'qid': qid, 'cursor': next_curs.urlsafe()}
+                nextPageUrl = '/view?' + urllib.urlencode(query_params)
+            else:
+                nextPageUrl = None
+            edit = False
+            query_params = {'qid': qid}
+            answerUrl = '/answer?' + urllib.urlencode(query_params)
+            title='View Question'
+        elif self.request.get('aid'):
+            # if there is aid, then is editing that answer, show that answer only
+            answerKey = self.answerKey
+            if not answerKey:
+                self.redirect('/')
+                return
+            aid = answerKey.urlsafe()
+            questionKey = answerKey.parent()
+            futures = ndb.get_multi_async([questionKey, answerKey])
+            self.signUrl
+            question, answers = [future.get_result() for future in futures]
+            nextPageUrl = None
+            edit = True
+            query_params = {'aid': aid}
+            answerUrl = '/edita?' + urllib.urlencode(query_params)
+            title='Edit Answer'
+        else:
+            self.redirect('/')
+            return
+        
+        if edit:
+            myVotes = {}
+        else:
+            myVotes = getUserVotes(current_user, [questionKey] + [answer.key for answer in answers])
+        
+        template_values = {
+            'title': title,
+            'question': question,
+            'answers': answers,
+            'myVotes': myVotes,
+            'nextPageUrl': nextPageUrl,
+            'uploadUrl': answerUrl,
+            'edit':edit
+        }
+        page = self.render('viewQuestion.html', template_values)
+        if not current_user and not edit and question:
+            PAGE_CACHE.set(cacheToken, (page, etag))
+        self.response.write(page)
+
+class RssPage(BaseHandler):
+    """ render rss page, for all questions, one tag or one question """
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/rss+xml;charset=utf-8'
+        tag = self.request.get('tag')
+        if self.request.get('qid'):
+            questionKey = self.questionKey
+            if not questionKey:
+                self.redirect('/')
+                return
+            #the single question feed goes stale together with its view page
+            cacheKey = ('rss', os.environ['HTTP_HOST'], questionKey.urlsafe())
+            cacheGroups = ['view:' + questionKey.urlsafe()]
+        elif tag:
+            cacheKey = ('rss', os.environ['HTTP_HOST'], self.request.uri)
+            cacheGroups = ['list:' + tag]
+        else:
+            cacheKey = ('rss', os.environ['HTTP_HOST'], self.request.uri)
+            cacheGroups = ['list']
+        feed, cacheToken = PAGE_CACHE.get(cacheKey, cacheGroups)
+        if feed is None:
+            feed = self.buildFeed(tag)
+            if feed is None:
+                self.redirect('/')
+                return
+            PAGE_CACHE.set(cacheToken, feed)
+
+        page, etag, lastModified = feed
+        self.response.etag = etag
+        if lastModified:
+            self.response.last_modified = lastModified
+        if self.notModified(etag, lastModified):
+            self.response.set_status(304)
+            return
+        self.response.write(page)
+
+    def notModified(self, etag, lastModified):
+        """ check the client's conditional headers against this feed """
+        if self.request.headers.get('If-None-Match'):
+            return etag in self.request.if_none_match
+        since = self.request.if_modified_since
+        if since and lastModified:
+            return lastModified.replace(microsecond=0) <= since.replace(tzinfo=None)
+        return False
+
+    def buildFeed(self, tag):
+        """ returns (xml, etag, last modified) of the feed, None if the
+            question does not exist """
+        if self.questionKey:
+            questionKey = self.questionKey
+            answers_future = Answer.query(ancestor=questionKey).order(-Answer.voteResult).fetch_async(RSS_ITEMS)
+            question = questionKey.get()
+            if question is None:
+                return None
+            title = 'Question Rss'
+            chanelLink='http://' + os.environ['HTTP_HOST'] +'/view?qid=' +questionKey.urlsafe()
+            chanelDes = 'Feed for single question with its answers'
+            questionLink = {}
+            questionLink[questionKey.id()]=chanelLink
+            answers = answers_future.get_result()
+            questions=None
+            lastModified = max([question.modifyTime] + [answer.modifyTime for answer in answers])
+        else:
+            questions_query = Question.query()
+            if tag:
+                title = 'Tag Rss'
+                questions_query = questions_query.filter(Question.tags == tag)
+                chanelDes = 'Feed for questions tagged ' + tag
+            else:
+                title = 'Mainpage Rss'
+                chanelDes = 'Feed for all questions'
+            questions = getListItems(questions_query.order(-Question.modifyTime).fetch(
+                RSS_ITEMS, keys_only=True))
+            chanelLink=self.request.uri
+            answers = None
+            questionLink={}
+            for question in questions:
+                questionLink[question.key.id()] = 'http://' + os.environ['HTTP_HOST'] + '/view?qid=' +question.key.urlsafe()
+            question = None
+            if questions:
+                lastModified = questions[0].modifyTime
+            else:
+                lastModified = None
+            
+        template_values = {
+            'title': title,
+            'chanelLink': chanelLink,
+            'chanelDes' : chanelDes,
+            'questions':questions,
+            'question' : question,
+            'answers' : answers,
+            'questionLink': questionLink
+        }
+
+        template = jinjaEnvironment().get_template('questionRSS.xml')
+        page = template.render(template_values)
+        #deletes and vote reordering leave modifyTime alone, the etag covers them
+        etag = hashlib.md5(page.encode('utf-8')).hexdigest()
+        return page, etag, lastModified
+
+class RedirectHandler(webapp2.RequestHandler):
+    def get(self):
+        if self.request.get('arg'):
+            url = self.request.get('arg')
+            self.redirect('/' + url)
+        else:
+            self.redirect('/')
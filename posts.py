@@ -0,0 +1,270 @@
+"""Handlers writing the forum: asking, answering, editing, voting and
+deleting.
+"""
+import datetime
+import urllib
+
+from google.appengine.api import users
+
+import unitofwork
+from question import (Answer, BaseHandler, castVote, deleteAnswer, deleteQuestion,
+                      image_variant_key, IMAGE_VARIANTS, invalidateQuestion, MAX_FILTER_TAGS,
+                      Question, renderContent, resolveKey, saveAnswer, saveQuestion,
+                      scheduleNotification, schedulePurge, scheduleSearchIndex,
+                      scheduleVoteAggregation, thread_key, voteWait)
+
+
+class AddQuestionPage(BaseHandler):
+    """ "render create question page and edit question page """
+
+    def get(self):
+        if not self.requireUser():
+            return
+        
+        #if there is qid, indicates this is editing, load the question
+        if self.request.get('qid'):
+            if not self.questionKey:
+                self.redirect('/')
+                return
+            question = self.questionKey.get()
+            if question is None:
+                self.redirect('/')
+                return
+            title = 'Edit Question'
+            upload_url = '/editq?qid=' + question.key.urlsafe()
+        else:
+            question=None
+            title = 'Create Question'
+            upload_url = '/question'
+               
+        template_values = {
+            'title': title,
+            'question':question,
+            'uploadUrl' : upload_url
+        }
+
+        self.response.write(self.render('createQuestion.html', template_values))
+
+class AddQuestion(BaseHandler):
+    """  handler to handle adding question """
+
+    def post(self):
+        question = Question()
+        question.author = self.requireUser('/')
+        if not question.author:
+            return
+        question.handle = self.request.get('qhandle')      
+        qtags = self.request.get('tag')
+        #insure the tags doesn't repeat
+        question.tags = set(qtags.split())
+        #a question write updates the count of every pair of its tags
+        if len(question.tags) > MAX_FILTER_TAGS:
+            self.response.write('<script type="text/javascript">alert(" At most %d tags per Question ! ");\
+                                 window.location.href="%s"</script>' %(MAX_FILTER_TAGS, '/create'))
+            return
+        #if content is empty, pop out error window.
+        content = self.request.get('qcontent')
+        if not content:
+            self.response.write('<script type="text/javascript">alert(" Question cannot be Empty ! ");\
+                                 window.location.href="%s"</script>' %('/create'))
+            return
+        question.content = content
+        renderContent(question)
+        question.voteResult = 0
+        question.modifyTime = datetime.datetime.now()
+        qkey = saveQuestion(question)
+        invalidateQuestion(qkey, question.tags)
+        scheduleSearchIndex(qkey)
+        query_params = {'qid': qkey.urlsafe()}
+        questionUrl = '/view?' + urllib.urlencode(query_params)
+        self.redirect(questionUrl)   
+
+class EditQuestion(BaseHandler):
+    """ This is the handler for editing question """
+    def post(self):
+        author = self.requireUser('/')
+        if not author:
+            return
+        
+        questionKey = self.questionKey
+        if not questionKey:
+            self.redirect('/')
+            return
+        question = questionKey.get()
+        if question is None or question.author != author:
+            self.redirect('/')
+            return
+        question.handle = self.request.get('qhandle')
+        query_params = {'qid': questionKey.urlsafe()}
+        questionEditUrl = '/create?' + urllib.urlencode(query_params)
+        content = self.request.get('qcontent')
+        if not content:
+            self.response.write('<script type="text/javascript">alert(" Question cannot be Empty ! ");\
+                                 window.location.href="%s"</script>' %(questionEditUrl))
+            return
+        tags = set(self.request.get('tag').split())
+        if len(tags) > MAX_FILTER_TAGS:
+            self.response.write('<script type="text/javascript">alert(" At most %d tags per Question ! ");\
+                                 window.location.href="%s"</script>' %(MAX_FILTER_TAGS, questionEditUrl))
+            return
+        question.content = content
+        renderContent(question)
+        oldTags = list(question.tags)
+        question.tags = tags
+        #change the modify time
+        question.modifyTime = datetime.datetime.now()
+        qkey = saveQuestion(question)
+        invalidateQuestion(qkey, oldTags + list(question.tags))
+        scheduleSearchIndex(qkey)
+        query_params = {'qid': qkey.urlsafe()}
+        questionUrl = '/view?' + urllib.urlencode(query_params)
+        self.redirect(questionUrl)                 
+
+class AnswerQuestion(BaseHandler):
+    """ handler for adding answers """
+    def post(self):       
+        if not self.requireUser('/'):
+            return
+        questionKey = self.questionKey
+        if not questionKey:
+            self.redirect('/')
+            return
+        answer = Answer(parent=questionKey)
+        query_params = {'qid': questionKey.urlsafe()}
+        questionUrl = '/view?' + urllib.urlencode(query_params)
+        answer.author = self.current_user
+        content = self.request.get('acontent')
+        if not content:
+            self.response.write('<script type="text/javascript">alert(" Answer cannot be Empty ! ");\
+                                 window.location.href="%s"</script>' %(questionUrl))
+            return
+        answer.content = content
+        renderContent(answer)
+        answer.voteResult = 0
+        answer.modifyTime = datetime.datetime.now()
+        question = saveAnswer(answer)
+        #list pages show the answer count
+        invalidateQuestion(questionKey, question.tags)
+        scheduleSearchIndex(questionKey)
+        scheduleNotification(answer.key)
+        self.redirect(questionUrl)    
+
+class EditAnswer(BaseHandler):
+    """ handler for editing answer """
+    def post(self):
+        author = self.requireUser('/')
+        if not author:
+            return
+          
+        answerKey = self.answerKey
+        if not answerKey:
+            self.redirect('/')
+            return
+        
+        answer = answerKey.get()
+        if answer is None or answer.author != author:
+            self.redirect('/')
+            return
+        qid = answerKey.parent().urlsafe()
+        query_params = {'qid':qid}
+        questionUrl = '/view?' + urllib.urlencode(query_params)        
+        content = self.request.get('acontent')
+        if not content:
+            self.response.write('<script type="text/javascript">alert(" Answer cannot be Empty ! ");\
+                                 window.location.href="%s"</script>' %(questionUrl))
+            return
+        answer.content = content
+        renderContent(answer)
+        answer.modifyTime = datetime.datetime.now()
+        question = saveAnswer(answer)
+        invalidateQuestion(answerKey.parent(), question.tags)
+        scheduleSearchIndex(answerKey.parent())
+        scheduleNotification(answerKey)
+        self.redirect(questionUrl) 
+
+class AddVote(BaseHandler):
+    """ handler for voting """
+    def post(self):
+        #an answer vote goes to the answer, its thread comes from the key,
+        #every check up to the rate limit runs without an RPC
+        if self.request.get('aid'):
+            target = self.parseKeyParam('aid', 'Answer')
+        else:
+            target = self.parseKeyParam('qid', 'Question')
+        value = self.request.get('value')
+        if not target or not value:
+            self.redirect('/')
+            return
+        query_params = {'qid': thread_key(target).urlsafe()}
+        questionUrl = '/view?' + urllib.urlencode(query_params)
+        if value != 'Up' and value != 'Down':
+            self.redirect(questionUrl) 
+            return
+                
+        current_user = self.requireUser(questionUrl)
+        if not current_user:
+            return
+
+        wait = voteWait(current_user, target)
+        if wait:
+            self.response.set_status(429, 'Too Many Requests')
+            self.response.headers['Retry-After'] = str(wait)
+            self.response.write('<script type="text/javascript">alert(" Too many votes, try again in %d seconds ! ");\
+                 window.location.href="%s"</script>' %(wait, questionUrl))
+            return
+            
+        target = resolveKey(target)
+        voted = castVote(current_user, target, value)
+        if voted is None:
+            self.redirect('/')
+            return
+        if not voted:
+            self.response.write('<script type="text/javascript">alert(" You already voted ! ");\
+                 window.location.href="%s"</script>' %(questionUrl))
+            return
+        #the vote count catches up once the shards are aggregated
+        scheduleVoteAggregation(target)
+        self.redirect(questionUrl)      
+
+class DeleteHandler(BaseHandler):
+    """ delete image question or answers """
+    def post(self):
+        if not self.admin:
+            signUrl = users.create_logout_url('/')
+            self.redirect(signUrl)
+            return
+        
+        if self.request.get('qid'):
+            questionKey = self.questionKey
+            if not questionKey:
+                self.redirect('/')
+                return
+            #the question disappears now, its answers and votes in the background
+            question = deleteQuestion(questionKey)
+            if question:
+                invalidateQuestion(questionKey, question.tags)
+                scheduleSearchIndex(questionKey)
+                schedulePurge(questionKey)
+            self.redirect('/')
+        elif self.request.get('aid'):
+            answerKey = self.answerKey
+            if not answerKey:
+                self.redirect('/')
+                return
+            questionKey = answerKey.parent()
+            question = deleteAnswer(answerKey)
+            invalidateQuestion(questionKey, question and question.tags)
+            scheduleSearchIndex(questionKey)
+            schedulePurge(answerKey)
+            self.redirect('/view?qid=' + questionKey.urlsafe())
+        elif self.request.get('imgid'):
+            #only image deletes need the blobstore
+            from google.appengine.ext import blobstore
+            imgid=self.request.get('imgid')
+            image = blobstore.BlobInfo.get(imgid)
+            if image:
+                image.delete()
+            unitofwork.delete(*[image_variant_key(imgid, variant) for variant in IMAGE_VARIANTS])
+            self.redirect('/image')
+        else:
+            self.redirect('/')   
@@ -1,703 +1,934 @@
 # [START imports]
+import time
+IMPORT_START = time.time()
+
 import os
 import urllib
-import datetime
-import re
+import hashlib
+import logging
+import random
 
 from google.appengine.api import users
 from google.appengine.ext import ndb
-from google.appengine.ext import blobstore
-from google.appengine.api import mail
-from google.appengine.datastore.datastore_query import Cursor
-from google.appengine.ext.webapp import blobstore_handlers
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 
 import jinja2
 import webapp2
 
+import instrument
+import linkrender
+import pagecache
+import ratelimit
+import unitofwork
 
-JINJA_ENVIRONMENT = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
-    extensions=['jinja2.ext.autoescape'],
-    autoescape=True)
+#a cold instance imports only this module, the handlers live in pages,
+#posts, imagepages and admin, which the router imports on the first
+#request to one of their routes. Blobstore, images and search are
+#imported where they are used, mail already is in notify.
 # [END imports]
 
 DEFAULT_USER_NAME = 'anonymous'
-
-
-# We set a parent key on the 'Questions' to ensure that they are all in the same
-# entity group. Queries across the single entity group will be consistent.
-# However, the write rate should be limited to ~1/second.
-
-#Custom jinja2 regex replacement filter
+MAX_FILTER_TAGS = 5 #tags combined in one list filter, and carried by one question
+LIST_ORDERS = [('', 'Newest'), ('active', 'Most Active'), ('top', 'Top Voted'),
+               ('unanswered', 'Unanswered')]
+ANSWERS_PER_PAGE = int(os.environ.get('ANSWERS_PER_PAGE', 20))
+RSS_ITEMS = 20 #newest entries carried by a feed
+TAG_DELTA_FORMAT = '%Y-%m-%d %H:%M:%S.%f' #activity time carried by tag index tasks
+TAG_DELTA_KEEP = 24 * 3600 #seconds applied tag index tasks are remembered
+TAG_REBUILD_BATCH = 100 #questions read per tag index recount task
+NOTIFY_WINDOW = 300 #seconds of answers collected into one notification digest
+SEARCH_INDEX_WINDOW = 5 #seconds of writes to one thread coalesced into one reindex
+SEARCH_ANSWERS = 200 #top voted answers included in a question's search document
+LIST_ITEM_TTL = 600 #seconds a cached list item lives without being invalidated
+LIST_ITEM_LOCK = 5 #seconds an invalidated list item cannot be cached again
+IMAGE_VARIANTS = {'thumb': 50, 'preview': 200} #bounding box in pixels of each derivative
+IMAGE_MAX_AGE = 365 * 24 * 3600 #blobs never change once uploaded
+IMAGES_PER_PAGE = 20
+DELETE_BATCH = 500 #keys per delete_multi when purging a thread
+MOVE_ANSWERS = 200 #answers moved in the transaction of a legacy thread, larger threads are copied ahead
+VOTE_SHARDS = 20 #pending vote deltas of one post are spread over this many shards
+VOTE_AGGREGATE_WINDOW = 10 #seconds between folding shards into voteResult
+
+#votes are rate limited per user and per user and target, 'memcache'
+#shares the buckets between instances
+if os.environ.get('VOTE_LIMIT_BACKEND') == 'memcache':
+    VoteLimiter = ratelimit.MemcacheLimiter
+else:
+    VoteLimiter = ratelimit.MemoryLimiter
+VOTE_USER_LIMIT = VoteLimiter('vote:user', 30, 60) #votes of one user per minute
+VOTE_TARGET_LIMIT = VoteLimiter('vote:target', 4, 300) #changes of one vote per five minutes
+
+#anonymous pages are served from here, 'memcache' shares it between instances
+#pages of another deployed version never match, like the template bytecode
+if os.environ.get('PAGE_CACHE_BACKEND') == 'memcache':
+    PAGE_CACHE = pagecache.PageCache(pagecache.MemcacheStore(
+        namespace='pagecache-%s' % os.environ.get('CURRENT_VERSION_ID', '')))
+else:
+    PAGE_CACHE = pagecache.PageCache(pagecache.MemoryStore())
+
+
+# Every question is the root of its own entity group holding its answers, so
+# writes to different threads never contend. Listing queries span all groups
+# and are eventually consistent. Questions written before used to share the
+# site_key() group, /admin/migratequestions moves them out keeping their ids.
+
+TEMPLATES = ('mainPage.html', 'viewQuestion.html', 'createQuestion.html', 'tags.html',
+             'search.html', 'images.html', 'stats.html', 'questionRSS.xml')
+_jinjaEnvironment = None
+
+#Custom jinja2 regex replacement filter, only needed for entities written
+#before contentHtml existed
 def replacelink(s):
     """a regex link convert filter"""
-    def replink(m):
-        imageString = 'http://' + os.environ['HTTP_HOST'] + '/img'
-        if m.group().endswith('.jpg') or m.group().endswith('.png') or m.group().endswith('.gif'):
-            return  '<img src="'  + m.group() + '">'
-        elif m.group().startswith(imageString):
-            return  '<img src="'  + m.group() + '">'
-        else:
-            return '<a href="' + m.group(1) + '">' + m.group(2) + '</a>'
-    return re.sub(r'(https?://([^ ,;\n]*))', replink, s)
-
-#replace link for mainpage, mainly just resize the image
-def replacelinkSmall(s):
-    """a regex link convert filter"""
-    def replink(m):
-        imageString = 'http://' + os.environ['HTTP_HOST'] + '/img'
-        if m.group().endswith('.jpg') or m.group().endswith('.png') or m.group().endswith('.gif'):
-            return  '<img src="'  + m.group() + '" height="50" width="50">' 
-        elif m.group().startswith(imageString):
-            return  '<img src="'  + m.group() + '" height="50" width="50">' 
-        else:
-            return '<a href="' + m.group(1) + '">' + m.group(2) + '</a>'
-    return re.sub(r'(https?://([^ ,;\n]*))', replink, s)
+    return linkrender.FULL.render(s)
 
 #Custom jinja2 quote filter
 def urlquote(s):
     """a regex quote filter"""
     return urllib.quote(s)
 
-def sendEmail(author, answer):
-    """  send email method """
-    if mail.is_email_valid(author.email()):
-        message = mail.EmailMessage(sender="Admin <wl1002@nyu.edu>",
-                            subject="Your question receives a new answer")
-
-        message.to = "%s <%s>" % (author.nickname(), author.email())
-        message.body = """
-        Dear %s:
-
-        Your question has received a new answer:
-
-        %s
-        
-        By
-        
-        %s
-        
-        Sincerely,
-        Ray Question Team
-        """ % (author.nickname(), answer.content, answer.author.nickname())
-        message.send()
-
+def jinjaEnvironment():
+    """ the template environment, created by the first request to render """
+    global _jinjaEnvironment
+    if _jinjaEnvironment is None:
+        #templates never change on a deployed instance, so skip the reload checks
+        #and share compiled bytecode between instances through memcache
+        environment = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
+            extensions=['jinja2.ext.autoescape'],
+            autoescape=True,
+            auto_reload=False,
+            bytecode_cache=jinja2.MemcachedBytecodeCache(
+                memcache.Client(), prefix='jinja2/bytecode/%s/' % os.environ.get('CURRENT_VERSION_ID', '')))
+        #templates report their render time to the instrumentation
+        environment.template_class = instrument.TimedTemplate
+        #filters are registered once here, handlers must never swap them per request
+        environment.filters['replink'] = replacelink
+        environment.filters['urlquote'] = urlquote
+        #threads racing here build equal environments, the last one stays
+        _jinjaEnvironment = environment
+    return _jinjaEnvironment
 
 def site_key():
-    """Constructs a website key for All questions."""
+    """Constructs the website key, parent of the tag index and of legacy questions."""
     return ndb.Key('Site', 'site')
 
+def migrated_key(key):
+    """Returns the key a legacy question or answer keeps after leaving the site group."""
+    return ndb.Key(pairs=key.pairs()[1:])
+
+def resolveKey(key):
+    """ the current key of a question or answer, a legacy key of a thread
+        that was already moved resolves to its new key """
+    if key.root() != site_key():
+        return key
+    #a thread that stayed because its id was taken keeps its legacy key,
+    #the entity at the moved key is another thread
+    legacy, moved = ndb.get_multi([key, migrated_key(key)])
+    if legacy is None and moved is not None:
+        return moved.key
+    return key
+
+def voter_key(user):
+    """Constructs the entity group key holding all votes of one user."""
+    return ndb.Key('Voter', user.user_id() or user.email())
+
+def thread_key(target):
+    """Returns the question key of the thread a question or answer belongs to."""
+    if target.kind() == 'Question':
+        return target
+    return target.parent()
+
+def vote_key(user, target):
+    """Constructs the key of user's vote on target, one get finds it."""
+    return ndb.Key('Vote', target.urlsafe(), parent=voter_key(user))
+
+def vote_shard_key(target, index):
+    """Constructs the key of one vote counter shard of a question or answer."""
+    return ndb.Key(VoteShard, '%s-%d' % (target.urlsafe(), index))
+
 class Vote(ndb.Model):
-    """Models an individual Vote entry """
+    """Models an individual Vote entry, kept in the voter's own entity group """
     author = ndb.UserProperty()
     value = ndb.StringProperty(indexed=False)
     createTime = ndb.DateTimeProperty(auto_now_add=True)
     modifyTime = ndb.DateTimeProperty(auto_now=True)
-    voteType = ndb.BooleanProperty()
+    voteType = ndb.BooleanProperty() #True for a question vote, False for an answer vote
+    target = ndb.KeyProperty() #the question or answer voted on
+    question = ndb.KeyProperty() #question of the thread, used by cascading deletes
+
+class VoteShard(ndb.Model):
+    """Models one shard of the not yet aggregated vote delta of a post """
+    target = ndb.KeyProperty()
+    count = ndb.IntegerProperty(indexed=False, default=0)
     
 class Question(ndb.Model):
     """Models an individual Question entry """
     author = ndb.UserProperty()
     content = ndb.StringProperty(indexed=False)
+    contentHtml = ndb.StringProperty(indexed=False) #content with links rendered
+    excerptHtml = ndb.StringProperty(indexed=False) #truncated, thumbnail rendering for lists
     createTime = ndb.DateTimeProperty(auto_now_add=True)
     handle = ndb.StringProperty(indexed=False)
     modifyTime = ndb.DateTimeProperty()
     tags = ndb.StringProperty(repeated=True)
     voteResult = ndb.IntegerProperty() #separate field store up-down vote number
+    #thread summary, kept in step by the answer and vote transactions
+    answerCount = ndb.IntegerProperty(default=0)
+    lastAnswerTime = ndb.DateTimeProperty(indexed=False)
+    lastAnswerAuthor = ndb.UserProperty(indexed=False)
+    lastActivity = ndb.DateTimeProperty() #newest of question and answer writes
+    version = ndb.IntegerProperty(indexed=False, default=0) #bumped by every write the thread page shows
     
 class Answer(ndb.Model):
     """Models an individual Answer entry """
     author = ndb.UserProperty()
     content = ndb.StringProperty(indexed=False)
+    contentHtml = ndb.StringProperty(indexed=False) #content with links rendered
     createTime = ndb.DateTimeProperty(auto_now_add=True)
     modifyTime = ndb.DateTimeProperty()
     voteResult = ndb.IntegerProperty() #separate field store up-down vote number
 
-# [START main_page]
-class MainPage(webapp2.RequestHandler):
-    """ mainpage to show all questions or qustions by tag  """
-    def get(self):
-        # if there is a tag, get questions by tag
-        if self.request.get('tag'):
-            tag = self.request.get('tag')
-            questions_query = Question.query(
-            ancestor=site_key()).filter(Question.tags == tag).order(-Question.modifyTime)
-        else:
-            questions_query = Question.query(
-            ancestor=site_key()).order(-Question.modifyTime)
-        
-        #check whether cursor exists
-        if self.request.get('cursor'):
-            try:
-                curs =Cursor(urlsafe=self.request.get('cursor'))
-            except:
-                self.redirect('/')
-                return          
-            questions, next_curs, more = questions_query.fetch_page(10, start_cursor=curs)
-
-        else:
-            questions, next_curs, more = questions_query.fetch_page(10)
-            
-        admin = False
-        if users.get_current_user():
-            signUrl = users.create_logout_url(self.request.uri)
-            current_user = users.get_current_user()
-            if users.is_current_user_admin():
-                admin = True
-        else:
-            signUrl = users.create_login_url(self.request.uri)
-            current_user = None
-
-        if more and next_curs:
-            if self.request.get('tag'):
-                query_params = {'cursor': next_curs.urlsafe(),'tag':self.request.get('tag')}
-            else:
-                query_params = {'cursor': next_curs.urlsafe()}
-            nextPageUrl =  '/list?' + urllib.urlencode(query_params)
-        else:
-            nextPageUrl=None
-        
-        template_values = {
-            'title': 'Question',
-            'questions': questions,
-            'current_user': current_user,
-            'signUrl': signUrl,
-            'nextPageUrl' : nextPageUrl,
-            'admin' : admin
-        }
-
-        #using customer filter to convert link
-        JINJA_ENVIRONMENT.filters['replink'] = replacelinkSmall
-        template = JINJA_ENVIRONMENT.get_template('mainPage.html')
-        self.response.write(template.render(template_values))
-# [END main_page]
-
-class GetTagsPage(webapp2.RequestHandler):
-    """  This is a page show all the tags """
-    def get(self):
-        if users.get_current_user():
-            signUrl = users.create_logout_url(self.request.uri)
-            current_user = users.get_current_user()
-        else:
-            signUrl = users.create_login_url(self.request.uri)
-            current_user = None
-        questions = Question.query(ancestor=site_key()).fetch()
-        tagsUrl={}
-        for question in questions:
-            for tag in question.tags:
-                if tag not in tagsUrl:
-                    query_params = {'tag': tag}
-                    tagsUrl[tag] = ('/list?' + urllib.urlencode(query_params))
-        template_values = {
-            'title':'Tags',
-            'tagsUrl':tagsUrl,
-            'current_user': current_user,
-            'signUrl': signUrl,
-        }
-
-        template = JINJA_ENVIRONMENT.get_template('tags.html')
-        self.response.write(template.render(template_values))
-        
-class GetImagesPage(webapp2.RequestHandler):
-    """  This is a page show all the images """
-    def get(self):
-        upload_url = blobstore.create_upload_url('/uploadImage')
-
-        if users.get_current_user():
-            signUrl = users.create_logout_url(self.request.uri)
-            current_user = users.get_current_user()
-        else:
-            signUrl = users.create_login_url(self.request.uri)
-            current_user = None
-            
-        if users.is_current_user_admin():
-            admin = True
-        else:
-            admin = False
-        
-        images =  blobstore.BlobInfo.gql("ORDER BY creation DESC").run()
-        template_values = {
-            'title':'Images',
-            'images':images,
-            'current_user': current_user,
-            'signUrl': signUrl,
-            'uploadUrl':upload_url,
-            'admin' : admin
-        }
-
-        template = JINJA_ENVIRONMENT.get_template('images.html')
-        self.response.write(template.render(template_values))
-     
-class AddQuestionPage(webapp2.RequestHandler):
-    """ "render create question page and edit question page """
-
-    def get(self):
-        if users.get_current_user():
-            signUrl = users.create_logout_url('/')
-            current_user = users.get_current_user()
+def renderContent(entity, host=None):
+    """ render the links of a question or answer once, at write time """
+    entity.contentHtml = linkrender.FULL.render(entity.content, host)
+    if isinstance(entity, Question):
+        entity.excerptHtml = linkrender.renderExcerpt(entity.content, host)
+
+class ImageVariant(ndb.Model):
+    """Models a resized copy of an uploaded image, keyed 'blob key/variant' """
+    data = ndb.BlobProperty()
+    contentType = ndb.StringProperty(indexed=False)
+
+def image_variant_key(blobKey, variant):
+    """Constructs the key of one derivative of an uploaded image."""
+    return ndb.Key(ImageVariant, '%s/%s' % (blobKey, variant))
+
+def deriveImage(blobKey, variant):
+    """ create and store one derivative, None if the blob is not an image """
+    from google.appengine.api import images
+    from google.appengine.ext import blobstore
+    size = IMAGE_VARIANTS[variant]
+    try:
+        image = images.Image(blob_key=blobKey)
+        image.resize(width=size, height=size)
+        data = image.execute_transforms(output_encoding=images.JPEG)
+    except (images.Error, blobstore.Error):
+        return None
+    variantImage = ImageVariant(key=image_variant_key(blobKey, variant),
+                                data=data, contentType='image/jpeg')
+    #the caller has the image now, the variants of a request are stored together
+    unitofwork.put(variantImage)
+    return variantImage
+
+def getImageVariant(blobKey, variant):
+    """ the stored derivative, images uploaded before derivatives existed
+        get theirs made on first request """
+    return image_variant_key(blobKey, variant).get() or deriveImage(blobKey, variant)
+
+class Tag(ndb.Model):
+    """Models a tag index entry, the tag itself is the key name """
+    count = ndb.IntegerProperty(indexed=False) #number of questions using this tag
+    lastActivity = ndb.DateTimeProperty(indexed=False)
+
+def tag_key(tag):
+    """Constructs the index key for a single tag."""
+    return ndb.Key(Tag, tag, parent=site_key())
+
+class TagPair(ndb.Model):
+    """Models how many questions carry both tags of a pair, keyed 'a|b' """
+    tags = ndb.StringProperty(repeated=True) #the two tags, sorted
+    count = ndb.IntegerProperty()
+
+def tag_pairs(tags):
+    """ every unordered pair of tags, each pair sorted """
+    tags = sorted(set(tags))
+    return [(a, b) for i, a in enumerate(tags) for b in tags[i + 1:]]
+
+def tag_pair_key(a, b):
+    """Constructs the co-occurrence key of two tags, in either order."""
+    return ndb.Key(TagPair, '|'.join(sorted([a, b])), parent=site_key())
+
+def updateTagIndex(oldTags, newTags, activity, work):
+    """ adjust the tag index and tag pair counts for a question going from
+        oldTags to newTags, the changes are added to work, must run in a
+        transaction on the site entity group """
+    oldTags = set(oldTags)
+    newTags = set(newTags)
+    keys = [tag_key(tag) for tag in oldTags | newTags]
+    oldPairs = set(tag_pairs(oldTags))
+    newPairs = set(tag_pairs(newTags))
+    pairs = list(oldPairs ^ newPairs)
+    #tags and pairs are read in one batch
+    entities = ndb.get_multi(keys + [tag_pair_key(*pair) for pair in pairs])
+    for key, tag in zip(keys, entities):
+        name = key.id()
+        if tag is None:
+            tag = Tag(key=key, count=0)
+        if name not in oldTags:
+            tag.count = tag.count + 1
+        elif name not in newTags:
+            tag.count = tag.count - 1
+        if tag.count <= 0:
+            work.delete(key)
+            continue
+        if name in newTags and (not tag.lastActivity or tag.lastActivity < activity):
+            tag.lastActivity = activity
+        work.put(tag)
+    for pair, entity in zip(pairs, entities[len(keys):]):
+        if entity is None:
+            entity = TagPair(key=tag_pair_key(*pair), tags=list(pair), count=0)
+        if pair in newPairs:
+            entity.count = entity.count + 1
         else:
-            signUrl = users.create_login_url('/')
-            self.redirect(signUrl) 
-            return
-        
-        #if there is qid, indicates this is editing, load the question
-        if self.request.get('qid'):
-            qid = self.request.get('qid')
-            try:
-                questionKey = ndb.Key(urlsafe = qid)
-            except:
-                self.redirect('/')
-                return
-            question = questionKey.get()
-            title = 'Edit Question'
-            upload_url = '/editq?qid=' + question.key.urlsafe()
+            entity.count = entity.count - 1
+        if entity.count <= 0:
+            work.delete(entity.key)
         else:
-            question=None
-            title = 'Create Question'
-            upload_url = '/question'
-               
-        template_values = {
-            'title': title,
-            'current_user': current_user,
-            'signUrl': signUrl,
-            'question':question,
-            'uploadUrl' : upload_url
-        }
-
-        template = JINJA_ENVIRONMENT.get_template('createQuestion.html')
-        self.response.write(template.render(template_values))
-        
+            work.put(entity)
 
-class AddQuestion(webapp2.RequestHandler):
-    """  handler to handle adding question """
+class TagDelta(ndb.Model):
+    """Models a tag index update already applied, keyed by its task name """
+    createTime = ndb.DateTimeProperty(auto_now_add=True)
 
-    def post(self):
-        question = Question(parent=site_key())
-        if users.get_current_user():
-            question.author = users.get_current_user()
-        else:
-            signUrl = users.create_login_url('/')
-            self.redirect(signUrl) 
-            return
-        question.handle = self.request.get('qhandle')      
-        qtags = self.request.get('tag')
-        #insure the tags doesn't repeat
-        question.tags = set(qtags.split())
-        #if content is empty, pop out error window.
-        if not self.request.get('qcontent'):
-            self.response.write('<script type="text/javascript">alert(" Question cannot be Empty ! ");\
-                                 window.location.href="%s"</script>' %('/create'))
-            return
-        question.content = self.request.get('qcontent')
-        question.voteResult = 0
-        question.modifyTime = datetime.datetime.now()
-        qkey = question.put()
-        query_params = {'qid': qkey.urlsafe()}
-        questionUrl = '/view?' + urllib.urlencode(query_params)
-        self.redirect(questionUrl)   
-      
-class EditQuestion(webapp2.RequestHandler):
-    """ This is the handler for editing question """
-    def post(self):
-        if users.get_current_user():
-            author = users.get_current_user()
-        else:
-            signUrl = users.create_login_url('/')
-            self.redirect(signUrl) 
-            return
-        
-        if self.request.get('qid'):
-            qid = self.request.get('qid')
-        else:
-            self.redirect('/')
-            return
-        try:
-            questionKey = ndb.Key(urlsafe=qid)
-        except:
-            self.redirect('/')
-            return
-        question = questionKey.get()
-        if question.author != author:
-            self.redirect('/')
-            return
-        question.handle = self.request.get('qhandle')
-        query_params = {'qid': qid}
-        questionEditUrl = '/create?' + urllib.urlencode(query_params)
-        if not self.request.get('qcontent'):
-            self.response.write('<script type="text/javascript">alert(" Question cannot be Empty ! ");\
-                                 window.location.href="%s"</script>' %(questionEditUrl))
-            return
-        question.content = self.request.get('qcontent')
-        question.tags =  set(self.request.get('tag').split())
-        #change the modify time
-        question.modifyTime = datetime.datetime.now()
-        qkey = question.put()
-        query_params = {'qid': qkey.urlsafe()}
-        questionUrl = '/view?' + urllib.urlencode(query_params)
-        self.redirect(questionUrl)                 
-
-class ViewQuestion(webapp2.RequestHandler):
-    """ render view question page """
-    #Add vote view vote handle order by vote
-    def get(self):
-        admin = False
-        if users.get_current_user():
-            signUrl = users.create_logout_url(self.request.uri)
-            current_user = users.get_current_user()
-            if users.is_current_user_admin():
-                admin=True
-        else:
-            signUrl = users.create_login_url(self.request.uri)
-            current_user = None
-       
-        if self.request.get('qid'):
-            qid = self.request.get('qid')
-            try:
-                questionKey = ndb.Key(urlsafe = qid)
-            except:
-                self.redirect('/')
-                return
-            question = questionKey.get()       
-            answers = Answer.query(ancestor=questionKey).order(-Answer.voteResult).fetch()
-            edit = False
-            query_params = {'qid': qid}
-            answerUrl = '/answer?' + urllib.urlencode(query_params)
-            title='View Question'
-        elif self.request.get('aid'):
-            # if there is aid, then is editing that answer, show that answer only
-            aid = self.request.get('aid')
-            try:
-                answerKey = ndb.Key(urlsafe = aid)
-            except:
-                self.redirect('/')
-                return
-            questionKey = answerKey.parent()
-            question = questionKey.get()
-            answers = answerKey.get()
-            edit = True
-            query_params = {'aid': aid}
-            answerUrl = '/edita?' + urllib.urlencode(query_params)
-            title='Edit Answer'
+class TagRebuild(ndb.Model):
+    """Models the tag index recount, in progress or last finished """
+    started = ndb.FloatProperty(indexed=False) #time.time() the recount started, names it
+    cursor = ndb.StringProperty(indexed=False) #where the next batch starts, '' for the first, None once finished
+    counts = ndb.JsonProperty(compressed=True) #tag -> [count, newest modifyTime as TAG_DELTA_FORMAT]
+    pairs = ndb.JsonProperty(compressed=True) #tag pair key name -> [a, b, count]
+    batches = ndb.JsonProperty(compressed=True) #[last question key flat(), time.time() of the read] per batch read, None for the last batch
+
+def tag_rebuild_key():
+    """Constructs the key of the single tag index recount."""
+    return ndb.Key(TagRebuild, 'tags', parent=site_key())
+
+def countTags(rebuild, tags, activity, step=1):
+    """ add step questions carrying tags, last modified at activity, to the
+        counts of a tag index recount """
+    if activity:
+        activity = activity.strftime(TAG_DELTA_FORMAT)
+    for tag in set(tags):
+        count, last = rebuild.counts.get(tag, (0, None))
+        if step > 0 and activity and (last is None or last < activity):
+            last = activity
+        rebuild.counts[tag] = [count + step, last]
+    for a, b in tag_pairs(tags):
+        name = tag_pair_key(a, b).id()
+        count = rebuild.pairs.get(name, [a, b, 0])[2]
+        rebuild.pairs[name] = [a, b, count + step]
+
+def tagRebuildReadTime(rebuild, questionKey):
+    """ when the recount read questionKey's batch, None if not yet """
+    #batches run in key order, flat() lists compare the way keys sort
+    flat = list(questionKey.flat())
+    for last, readTime in rebuild.batches:
+        if last is None or flat <= last:
+            return readTime
+    return None
+
+def scheduleTagDelta(questionKey, oldTags, newTags, activity):
+    """ queue the tag index update of a question write, in the write's
+        transaction, the tagindex queue applies them one at a time """
+    params = {'question': questionKey.urlsafe(), 'queued': repr(time.time()),
+              'old': [tag.encode('utf-8') for tag in set(oldTags)],
+              'new': [tag.encode('utf-8') for tag in set(newTags)]}
+    if activity:
+        params['activity'] = activity.strftime(TAG_DELTA_FORMAT)
+    taskqueue.add(url='/admin/tags/delta', queue_name='tagindex', params=params,
+                  transactional=True)
+
+@ndb.transactional
+def applyTagDelta(taskName, questionKey, oldTags, newTags, activity, queued):
+    """ apply one queued tag index update, retries of its task find the
+        marker. The tagindex queue runs the recount's batches in between:
+        a write queued after the recount read its question is added to the
+        recount's counts as well, one queued before is in them already and
+        is skipped once the recount has replaced the index. A write whose
+        transaction spans a batch read may stay off by one until the next
+        recount """
+    markerKey = ndb.Key(TagDelta, taskName, parent=site_key())
+    marker, rebuild = ndb.get_multi([markerKey, tag_rebuild_key()])
+    if marker:
+        return
+    work = unitofwork.UnitOfWork()
+    readTime = None
+    if rebuild and questionKey and queued:
+        readTime = tagRebuildReadTime(rebuild, questionKey)
+    counted = readTime is not None and queued <= readTime
+    running = rebuild is not None and rebuild.cursor is not None
+    if running or not counted:
+        updateTagIndex(oldTags, newTags, activity, work)
+    if running and readTime is not None and not counted:
+        countTags(rebuild, oldTags, None, -1)
+        countTags(rebuild, newTags, activity)
+        work.put(rebuild)
+    work.put(TagDelta(key=markerKey))
+    work.flush()
+
+@ndb.transactional
+def saveQuestion(question):
+    """ put a question and queue the matching tag index update """
+    stored = question.key and question.key.get()
+    oldTags = ()
+    if stored:
+        oldTags = stored.tags
+        #votes and answers may have landed since the question was read
+        question.voteResult = stored.voteResult
+        question.answerCount = stored.answerCount
+        question.lastAnswerTime = stored.lastAnswerTime
+        question.lastAnswerAuthor = stored.lastAnswerAuthor
+        question.lastActivity = max(stored.lastActivity, question.modifyTime)
+        question.version = (stored.version or 0) + 1
+    else:
+        question.lastActivity = question.modifyTime
+    qkey = question.put()
+    scheduleTagDelta(qkey, oldTags, question.tags, question.modifyTime)
+    return qkey
+
+@ndb.transactional
+def saveAnswer(answer):
+    """ put an answer and update its question's summary, returns the question """
+    question = answer.key.parent().get()
+    if answer.key.id():
+        #a folded vote may have landed since the answer was read
+        stored = answer.key.get()
+        if stored:
+            answer.voteResult = stored.voteResult
+    else:
+        question.answerCount = (question.answerCount or 0) + 1
+        question.lastAnswerTime = answer.modifyTime
+        question.lastAnswerAuthor = answer.author
+    question.lastActivity = max(question.lastActivity, answer.modifyTime)
+    question.version = (question.version or 0) + 1
+    ndb.put_multi([answer, question])
+    return question
+
+@ndb.transactional
+def deleteAnswer(answerKey):
+    """ delete an answer and update its question's summary, returns the
+        question, None if there was no answer or no question """
+    answer, question = ndb.get_multi([answerKey, answerKey.parent()])
+    if answer is None:
+        #a repeated delete must not count the answer twice
+        return None
+    if question is None:
+        answerKey.delete()
+        return None
+    #the query still sees the answer being deleted, skip it
+    latest = [answer for answer in Answer.query(ancestor=question.key).order(-Answer.createTime).fetch(2)
+              if answer.key != answerKey]
+    question.answerCount = max((question.answerCount or 0) - 1, 0)
+    if latest:
+        question.lastAnswerTime = latest[0].modifyTime
+        question.lastAnswerAuthor = latest[0].author
+    else:
+        question.lastAnswerTime = None
+        question.lastAnswerAuthor = None
+    question.version = (question.version or 0) + 1
+    unitofwork.write([question], [answerKey])
+    return question
+
+@ndb.transactional
+def deleteQuestion(questionKey):
+    """ delete a question and queue dropping its stored tags from the tag
+        index, returns the deleted question, None if there was none """
+    question = questionKey.get()
+    if question is None:
+        return None
+    questionKey.delete()
+    scheduleTagDelta(questionKey, question.tags, (), None)
+    return question
+
+def legacyVote(user, target):
+    """ user's old style vote on target, stored as a child of target """
+    #a question's descendants hold the votes on its answers too
+    for vote in Vote.query(Vote.author == user, ancestor=target):
+        if vote.key.parent() == target:
+            return vote
+    return None
+
+@ndb.transactional(xg=True)
+def castVote(user, target, value):
+    """ record user's Up/Down vote on target and add it to a random counter
+        shard, returns False if the user already voted that way, None if
+        target does not exist """
+    vote, entity = ndb.get_multi([vote_key(user, target), target])
+    if entity is None:
+        return None
+    legacy = None
+    if vote is None:
+        #a vote not migrated yet moves to its new key with this write
+        legacy = legacyVote(user, target)
+        vote = Vote(key=vote_key(user, target))
+        vote.author = user
+        vote.target = target
+        vote.question = thread_key(target)
+        vote.voteType = target.kind() == 'Question'
+        if legacy:
+            vote.value = legacy.value
+            vote.createTime = legacy.createTime
+    if vote.value is None:
+        vote.value = value
+    elif vote.value == value:
+        return False
+    elif vote.value == 'none':
+        vote.value = value
+    else:
+        vote.value = 'none'
+    shardKey = vote_shard_key(target, random.randint(0, VOTE_SHARDS - 1))
+    shard = shardKey.get() or VoteShard(key=shardKey, target=target)
+    if value == 'Up':
+        shard.count = shard.count + 1
+    else:
+        shard.count = shard.count - 1
+    unitofwork.write([vote, shard], [legacy.key] if legacy else [])
+    return True
+
+@ndb.transactional(xg=True)
+def aggregateVotes(target):
+    """ fold the pending shard deltas of target into its voteResult,
+        returns the updated question or answer, None if nothing changed """
+    shards = [shard for shard in ndb.get_multi(
+        [vote_shard_key(target, i) for i in range(VOTE_SHARDS)]) if shard]
+    if not shards:
+        return None
+    entity = target.get()
+    if entity is None and target.root() == site_key():
+        #the thread left the site group after the vote was cast
+        entity = migrated_key(target).get()
+    if entity:
+        entity.voteResult = (entity.voteResult or 0) + sum(shard.count for shard in shards)
+        changed = [entity]
+        #answer votes reorder the thread page, its question carries the version
+        if target.kind() == 'Question':
+            question = entity
         else:
-            self.redirect('/')
-            return
-        
-        template_values = {
-            'title': title,
-            'current_user': current_user,
-            'signUrl': signUrl,
-            'question': question,
-            'answers': answers,
-            'uploadUrl': answerUrl,
-            'edit':edit,
-            'admin' : admin
-        }
-        JINJA_ENVIRONMENT.filters['replink'] = replacelink
-        JINJA_ENVIRONMENT.filters['urlquote'] = urlquote
-        template = JINJA_ENVIRONMENT.get_template('viewQuestion.html')
-        self.response.write(template.render(template_values))
-       
-class AnswerQuestion(webapp2.RequestHandler):
-    """ handler for adding answers """
-    def post(self):       
-        if not users.get_current_user():
-            signUrl = users.create_login_url('/')
-            self.redirect(signUrl) 
-            return
-        qid = self.request.get('qid')
-        if not qid:
-            self.redirect('/')
-            return
-        try:
-            questionKey = ndb.Key(urlsafe = qid)
-        except:
-            self.redirect('/')
-            return
-        answer = Answer(parent=questionKey)
-        query_params = {'qid': qid}
-        questionUrl = '/view?' + urllib.urlencode(query_params)
-        answer.author = users.get_current_user()       
-        if not self.request.get('acontent'):
-            self.response.write('<script type="text/javascript">alert(" Answer cannot be Empty ! ");\
-                                 window.location.href="%s"</script>' %(questionUrl))
-            return
-        answer.content = self.request.get('acontent')
-        answer.voteResult = 0
-        answer.modifyTime = datetime.datetime.now()
-        answer.put()
-        sendEmail(questionKey.get().author, answer)
-        self.redirect(questionUrl)    
-
-class EditAnswer(webapp2.RequestHandler):
-    """ handler for editing answer """
-    def post(self):
-        if users.get_current_user():
-            author = users.get_current_user()
-        else:
-            signUrl = users.create_login_url('/')
-            self.redirect(signUrl) 
-            return
-          
-        if self.request.get('aid'):
-            aid = self.request.get('aid')
-        else:
-            self.redirect('/')
-            return    
-            
+            question = thread_key(entity.key).get()
+            if question:
+                changed.append(question)
+        if question:
+            question.version = (question.version or 0) + 1
+    else:
+        changed = []
+    unitofwork.write(changed, [shard.key for shard in shards])
+    return entity
+
+@ndb.transactional(xg=True)
+def migrateVote(old):
+    """ re-create an old style vote under its voter and delete the original,
+        a vote already at the new key is newer and kept """
+    target = old.key.parent()
+    key = vote_key(old.author, target)
+    puts = []
+    if key.get() is None:
+        vote = Vote(key=key)
+        vote.author = old.author
+        vote.value = old.value
+        vote.createTime = old.createTime
+        vote.target = target
+        vote.question = thread_key(target)
+        vote.voteType = target.kind() == 'Question'
+        puts.append(vote)
+    unitofwork.write(puts, [old.key])
+
+def getUserVotes(user, targets):
+    """ batch lookup of user's votes, returns target urlsafe -> vote value """
+    if not user or not targets:
+        return {}
+    votes = ndb.get_multi([vote_key(user, target) for target in targets])
+    return dict((vote.target.urlsafe(), vote.value) for vote in votes if vote)
+
+def foldedVotes(target, entity):
+    """ follow up on a vote aggregation that changed entity """
+    if entity is None:
+        return
+    if target.kind() == 'Question':
+        #list pages show the question's votes
+        invalidateQuestion(entity.key, entity.tags)
+        scheduleSearchIndex(entity.key)
+    else:
+        invalidateQuestion(thread_key(entity.key))
+
+def voteWait(user, target):
+    """ seconds user must wait before voting on target, 0 if the vote may go
+        ahead, only touches the rate limiter buckets """
+    userId = user.user_id() or user.email()
+    return VOTE_TARGET_LIMIT.take(userId + ' ' + target.urlsafe()) or VOTE_USER_LIMIT.take(userId)
+
+def scheduleVoteAggregation(target):
+    """ enqueue one aggregation task per target per window, repeats coalesce """
+    window = int(time.time()) // VOTE_AGGREGATE_WINDOW
+    unitofwork.addTask(taskqueue.Task(name='votes-%s-%d' % (target.urlsafe(), window),
+                                      url='/admin/aggregatevotes',
+                                      params={'target': target.urlsafe()},
+                                      countdown=VOTE_AGGREGATE_WINDOW))
+
+def scheduleSearchIndex(questionKey):
+    """ enqueue one search reindex of the thread per window """
+    window = int(time.time()) // SEARCH_INDEX_WINDOW
+    unitofwork.addTask(taskqueue.Task(name='search-%s-%d' % (questionKey.urlsafe(), window),
+                                      url='/admin/search/index',
+                                      params={'question': questionKey.urlsafe()},
+                                      countdown=SEARCH_INDEX_WINDOW))
+
+def threadEtag(question, cursor):
+    """ etag of a thread page, from the question fields every change to
+        the thread updates, so it is known before any answer is read """
+    parts = (os.environ.get('CURRENT_VERSION_ID'), os.environ['HTTP_HOST'], question.key.urlsafe(),
+             question.version, question.modifyTime, question.voteResult, question.answerCount,
+             question.lastActivity, cursor)
+    return hashlib.md5(repr(parts)).hexdigest()
+
+class ListItem(object):
+    """ what list pages and feeds show of a question, without its content """
+    __slots__ = ('key', 'handle', 'excerpt', 'excerptHtml', 'tags', 'author', 'voteResult',
+                 'answerCount', 'lastAnswerTime', 'lastAnswerAuthor', 'createTime', 'modifyTime')
+
+    def __init__(self, key, values):
+        self.key = key
+        (self.handle, self.excerpt, self.excerptHtml, self.tags, self.author, self.voteResult,
+         self.answerCount, self.lastAnswerTime, self.lastAnswerAuthor, self.createTime,
+         self.modifyTime) = values
+
+def listItemValues(question):
+    """ the cached tuple a ListItem is built from """
+    return (question.handle, linkrender.truncate(question.content or u''),
+            question.excerptHtml or linkrender.renderExcerpt(question.content or u''),
+            question.tags, question.author, question.voteResult or 0, question.answerCount or 0,
+            question.lastAnswerTime, question.lastAnswerAuthor, question.createTime,
+            question.modifyTime)
+
+def list_item_key(questionKey):
+    return questionKey.urlsafe()
+
+def getListItems(keys):
+    """ list items of the questions of keys in order, deleted ones dropped,
+        items missing from memcache are built from one get_multi """
+    cacheKeys = [list_item_key(key) for key in keys]
+    values = memcache.get_multi(cacheKeys, namespace='listitems')
+    missing = [key for key, cacheKey in zip(keys, cacheKeys) if cacheKey not in values]
+    if missing:
+        built = dict((list_item_key(question.key), listItemValues(question))
+                     for question in ndb.get_multi(missing) if question)
+        #add, not set: an item invalidated while it was read stays out
+        memcache.add_multi(built, time=LIST_ITEM_TTL, namespace='listitems')
+        values.update(built)
+    return [ListItem(key, values[cacheKey]) for key, cacheKey in zip(keys, cacheKeys)
+            if cacheKey in values]
+
+def forgetListItems(keys):
+    """ drop the cached list items of the questions of keys """
+    memcache.delete_multi([list_item_key(key) for key in keys], seconds=LIST_ITEM_LOCK,
+                          namespace='listitems')
+
+def invalidatePages(groups):
+    PAGE_CACHE.invalidate(*groups)
+
+def invalidateQuestion(questionKey, tags=None):
+    """ drop cached pages showing the question, tags is given when the
+        question list itself changed (create, edit, delete). In a request
+        the drops of every question wait for the commit and go out as one
+        memcache delete and one page cache invalidation """
+    groups = ['view:' + questionKey.urlsafe()]
+    if tags is not None:
+        groups.append('list')
+        groups.extend('list:' + tag for tag in set(tags))
+    unitofwork.collect(forgetListItems, questionKey)
+    unitofwork.collect(invalidatePages, *groups)
+
+class NotificationDigest(ndb.Model):
+    """Models the answers waiting to be mailed to one author in one window """
+    recipient = ndb.UserProperty()
+    answers = ndb.KeyProperty(repeated=True)
+
+def scheduleNotification(answerKey):
+    """ queue the answer for its question author's next digest """
+    unitofwork.addTask(taskqueue.Task(url='/admin/notify/answer',
+                                      params={'answer': answerKey.urlsafe()}),
+                       'notifications')
+
+@ndb.transactional
+def addToDigest(digestKey, recipient, answerKey):
+    digest = digestKey.get() or NotificationDigest(key=digestKey, recipient=recipient)
+    if answerKey not in digest.answers:
+        digest.answers.append(answerKey)
+        digest.put()
+
+@ndb.transactional
+def clearDigest(digestKey, sent):
+    """ drop the sent answers, returns True if new ones arrived meanwhile """
+    digest = digestKey.get()
+    if digest is None:
+        return False
+    digest.answers = [answer for answer in digest.answers if answer not in sent]
+    if digest.answers:
+        digest.put()
+        return True
+    digestKey.delete()
+    return False
+
+def purgeBatch(key):
+    """ delete one batch of what hangs off a deleted question or answer,
+        returns the number of entities deleted """
+    #answers and votes written before the migration live under the key itself
+    children_future = ndb.Query(ancestor=key).fetch_async(DELETE_BATCH, keys_only=True)
+    if key.kind() == 'Question':
+        votes_query = Vote.query(Vote.question == key)
+    else:
+        votes_query = Vote.query(Vote.target == key)
+    keys = children_future.get_result() + votes_query.fetch(DELETE_BATCH, keys_only=True)
+    #the next batch queries again, so this one is written now, not at the
+    #commit, vote shards of deleted posts are dropped by the aggregation sweep
+    unitofwork.write([], keys)
+    return len(keys)
+
+def schedulePurge(key):
+    unitofwork.addTask(taskqueue.Task(url='/admin/purge', params={'key': key.urlsafe()}))
+
+def copyAnswers(answerKeys):
+    """ copy legacy answers to the keys they get when their thread moves,
+        unseen until the question itself moves """
+    answers = [answer for answer in ndb.get_multi(answerKeys) if answer]
+    unitofwork.write([Answer(key=migrated_key(answer.key), **answer.to_dict())
+                      for answer in answers], [])
+
+@ndb.transactional(xg=True)
+def copyThread(legacyKey, version, answerKeys):
+    """ move a legacy question and answerKeys out of the site group under
+        the same ids, returns the moved question, None if it is gone, was
+        written to since it was at version, or its id is taken """
+    question = legacyKey.get()
+    if question is None or question.version != version:
+        return None
+    movedKey = migrated_key(legacyKey)
+    #legacy ids came from the site group's id space, a new question may hold one
+    if movedKey.get():
+        logging.error('question %s cannot move, %s exists', legacyKey.id(), movedKey)
+        return None
+    moved = Question(key=movedKey, **question.to_dict())
+    answers = [answer for answer in ndb.get_multi(answerKeys) if answer]
+    unitofwork.write([moved] + [Answer(key=migrated_key(answer.key), **answer.to_dict())
+                                for answer in answers],
+                     [legacyKey] + [answer.key for answer in answers])
+    return moved
+
+@ndb.transactional(xg=True)
+def moveVote(vote, target):
+    """ re-create a vote on the moved target under its voter, drop the old
+        one, a vote already at the new key is newer and kept """
+    key = vote_key(vote.author, target)
+    puts = []
+    if key.get() is None:
+        moved = Vote(key=key, **vote.to_dict())
+        moved.target = target
+        moved.question = thread_key(target)
+        moved.voteType = target.kind() == 'Question'
+        puts.append(moved)
+    unitofwork.write(puts, [vote.key])
+
+def moveThread(legacyKey):
+    """ move one legacy thread into its own entity group, returns False if
+        it stays, see copyThread """
+    #pending shards are folded while the thread is still where they point
+    for target in [legacyKey] + Answer.query(ancestor=legacyKey).fetch(keys_only=True):
+        aggregateVotes(target)
+    question = legacyKey.get()
+    if question is None:
+        return True
+    if migrated_key(legacyKey).get():
+        logging.error('question %s cannot move, %s exists', legacyKey.id(), migrated_key(legacyKey))
+        return False
+    version = question.version
+    answerKeys = Answer.query(ancestor=legacyKey).fetch(keys_only=True)
+    if len(answerKeys) > MOVE_ANSWERS:
+        #too many writes for one transaction, the answers are copied ahead and
+        #the legacy ones purged after the move, the version check catches
+        #writes in between
+        copied = set(migrated_key(key) for key in answerKeys)
+        unitofwork.write([], [key for key in Answer.query(ancestor=migrated_key(legacyKey)).fetch(
+            keys_only=True) if key not in copied])
+        for i in range(0, len(answerKeys), MOVE_ANSWERS):
+            copyAnswers(answerKeys[i:i + MOVE_ANSWERS])
+        question = copyThread(legacyKey, version, [])
+        if question:
+            schedulePurge(legacyKey)
+    else:
+        question = copyThread(legacyKey, version, answerKeys)
+    if question is None:
+        return False
+    #votes from before they moved to their voter's group still hang off their target
+    for vote in Vote.query(ancestor=legacyKey).fetch():
+        moveVote(vote, migrated_key(vote.key.parent()))
+    for vote in Vote.query(Vote.question == legacyKey).fetch():
+        moveVote(vote, migrated_key(vote.target))
+    import searchindex
+    searchindex.delete([legacyKey.urlsafe()])
+    scheduleSearchIndex(question.key)
+    invalidateQuestion(legacyKey)
+    invalidateQuestion(question.key, question.tags)
+    return True
+
+class BaseHandler(webapp2.RequestHandler):
+    """ request handler memoizing what every page asks for: the signed in
+        user, the admin flag, the sign in/out url and the qid/aid keys, each
+        is computed on first use and at most once per request """
+
+    @webapp2.cached_property
+    def current_user(self):
+        return users.get_current_user()
+
+    @webapp2.cached_property
+    def admin(self):
+        return bool(self.current_user) and users.is_current_user_admin()
+
+    @webapp2.cached_property
+    def signUrl(self):
+        """ sign out url for a signed in user, sign in url otherwise """
+        if self.current_user:
+            return users.create_logout_url(self.request.uri)
+        return users.create_login_url(self.request.uri)
+
+    @webapp2.cached_property
+    def questionKey(self):
+        """ the question key in qid, None if missing or invalid """
+        return self.keyParam('qid', 'Question')
+
+    @webapp2.cached_property
+    def answerKey(self):
+        """ the answer key in aid, None if missing or invalid """
+        return self.keyParam('aid', 'Answer')
+
+    def parseKeyParam(self, name, kind):
+        """ the key in request parameter name if it is a valid key of kind,
+            else None, without any RPC """
+        value = self.request.get(name)
+        if not value:
+            return None
         try:
-            answerKey = ndb.Key(urlsafe=aid)
+            key = ndb.Key(urlsafe=value)
         except:
-            self.redirect('/')
-            return
-        
-        answer = answerKey.get()
-        if answer.author != author:
-            self.redirect('/')
-            return
-        qid = answerKey.parent().urlsafe()
-        query_params = {'qid':qid}
-        questionUrl = '/view?' + urllib.urlencode(query_params)        
-        if not self.request.get('acontent'):
-            self.response.write('<script type="text/javascript">alert(" Answer cannot be Empty ! ");\
-                                 window.location.href="%s"</script>' %(questionUrl))
-            return
-        answer.content = self.request.get('acontent')
-        answer.modifyTime = datetime.datetime.now()
-        answer.put()
-        sendEmail(answerKey.parent().get().author, answer)
-        self.redirect(questionUrl) 
-        
-class AddVote(webapp2.RequestHandler):
-    """ handler for voting """
-    def post(self):
-        if (self.request.get('qid') or self.request.get('aid')) and self.request.get('value'):
-            if self.request.get('qid'):
-                qid = self.request.get('qid')
-                try:
-                    questionKey = ndb.Key(urlsafe = qid)
-                except:
-                    self.redirect('/')
-                    return
-                query_params = {'qid': qid}
-                questionUrl = '/view?' + urllib.urlencode(query_params)
-            
-            if self.request.get('aid'):
-                aid = self.request.get('aid')    
-                try:
-                    answerKey = ndb.Key(urlsafe = aid)
-                except:
-                    if self.request.get('qid'):
-                        self.redirect(questionUrl)
-                    else:
-                        self.redirect('/')
-                    return
-                if not self.request.get('qid'):
-                    qid = answerKey.parent().urlsafe()
-                    query_params = {'qid': qid}
-                    questionUrl = '/view?' + urllib.urlencode(query_params)
-            
-            if self.request.get('value') == 'Up' or self.request.get('value') == 'Down':
-                value = self.request.get('value')
-            else:
-                self.redirect(questionUrl) 
-                return
-                
-            if not users.get_current_user():
-                signUrl = users.create_login_url(questionUrl)
-                self.redirect(signUrl) 
-                return
-            
-            current_user = users.get_current_user()
-            
-            if self.request.get('aid'):
-                answer = answerKey.get();
-                votes = Vote.query(ancestor=answerKey).fetch()
-
-                voteFound = False
-                for vote in votes:
-                    if vote.author == current_user:
-                        voteFound=True
-                        if value == vote.value:
-                            self.response.write('<script type="text/javascript">alert(" You already voted ! ");\
-                                 window.location.href="%s"</script>' %(questionUrl))
-                            return
-                        else:
-                            if vote.value == 'none':
-                                vote.value = value
-                            else:
-                                vote.value = 'none'
-                            vote.put()
-                        break
-                
-                if not voteFound:
-                    newVote = Vote(parent=answerKey)
-                    newVote.value = value
-                    newVote.author = current_user
-                    newVote.voteType = False
-                    newVote.put()
-                if value == 'Up':       
-                    answer.voteResult = answer.voteResult + 1
-                else:
-                    answer.voteResult = answer.voteResult - 1
-                answer.put()
-                             
-            else:
-                question = questionKey.get()
-                votes = Vote.query(ancestor=questionKey).filter(Vote.voteType==True).fetch()
-                voteFound = False
-                for vote in votes:
-                    if vote.author == current_user:
-                        voteFound=True
-                        if value == vote.value:
-                            self.response.write('<script type="text/javascript">alert(" You already voted ! ");\
-                                 window.location.href="%s"</script>' %(questionUrl))
-                            return
-                        else:
-                            if vote.value == 'none':
-                                vote.value = value
-                            else:
-                                vote.value = 'none'
-                            vote.put()
-                        break
-                
-                if not voteFound:
-                    newVote = Vote(parent=questionKey)
-                    newVote.value = value
-                    newVote.author = current_user
-                    newVote.voteType = True
-                    newVote.put()
-                if value == 'Up':       
-                    question.voteResult = question.voteResult + 1
-                else:
-                    question.voteResult = question.voteResult - 1
-                question.put()
-            self.redirect(questionUrl)      
-        else:
-            self.redirect('/')
-            return             
-
-class RssPage(webapp2.RequestHandler):
-    """ render rss page """
-    def get(self):
-        if self.request.get('qid'):
-            qid = self.request.get('qid')
-            try:
-                questionKey = ndb.Key(urlsafe = qid)
-            except:
-                self.redirect('/')
-                return
-            question = questionKey.get()
-            title = 'Question Rss'
-            chanelLink='http://' + os.environ['HTTP_HOST'] +'/view?qid=' +questionKey.urlsafe()
-            chanelDes = 'Feed for single question with its answers'
-            questionLink = {}
-            questionLink[questionKey.id()]=chanelLink
-            answers=Answer.query(ancestor=questionKey).order(-Answer.voteResult).fetch()
-            questions=None
-        else:
-            title = 'Mainpage Rss'
-            questions = Question.query(ancestor=site_key()).order(-Question.modifyTime).fetch()
-            chanelLink=self.request.uri
-            chanelDes = 'Feed for all questions'
-            answers = None
-            questionLink={}
-            for question in questions:
-                questionLink[question.key.id()] = 'http://' + os.environ['HTTP_HOST'] + '/view?qid=' +question.key.urlsafe()
-            question = None
-            
+            return None
+        if key.kind() != kind:
+            return None
+        return key
+
+    def keyParam(self, name, kind):
+        key = self.parseKeyParam(name, kind)
+        if key is None:
+            return None
+        #links to threads still in, or moved out of, the site group keep working
+        return resolveKey(key)
+
+    def requireUser(self, continueUrl=None):
+        """ the signed in user, or None after redirecting to the sign in page """
+        if not self.current_user:
+            self.redirect(users.create_login_url(continueUrl or self.request.uri))
+        return self.current_user
+
+    def checkEtag(self, etag):
+        """ tag an anonymous page with etag, True after answering 304 when
+            the client already holds it. Shared caches must revalidate
+            every reuse, signed in visitors then get their own page """
+        self.response.etag = etag
+        self.response.headers['Cache-Control'] = 'public, no-cache'
+        self.response.headers['Vary'] = 'Cookie'
+        if etag in self.request.if_none_match:
+            self.response.set_status(304)
+            return True
+        return False
+
+    def templateValues(self, values):
+        """ values with the user, sign url and admin flag filled in """
         template_values = {
-            'title': title,
-            'chanelLink': chanelLink,
-            'chanelDes' : chanelDes,
-            'questions':questions,
-            'question' : question,
-            'answers' : answers,
-            'questionLink': questionLink
+            'current_user': self.current_user,
+            'signUrl': self.signUrl,
+            'admin': self.admin
         }
-
-        self.response.headers['Content-Type'] = 'application/rss+xml;charset=utf-8'
-        template = JINJA_ENVIRONMENT.get_template('questionRSS.xml')
-        self.response.write(template.render(template_values))
-
-class ImageHandler(blobstore_handlers.BlobstoreDownloadHandler):
-    def get(self, resource):
-        resource = str(urllib.unquote(resource))
-        blob_info = blobstore.BlobInfo.get(resource)
-        self.send_blob(blob_info)
-        
-class UploadImageHandler(blobstore_handlers.BlobstoreUploadHandler):
-    def post(self):
-        self.redirect('/redirect?arg=image') 
-
-class RedirectHandler(webapp2.RequestHandler):
+        template_values.update(values)
+        return template_values
+
+    def render(self, templateName, values):
+        template = jinjaEnvironment().get_template(templateName)
+        return template.render(self.templateValues(values))
+
+class JobHandler(webapp2.RequestHandler):
+    """ base of the task queue, cron and admin jobs. App Engine strips the
+        X-AppEngine headers from outside requests, so one of them means the
+        task queue or cron sent it, any other caller must be a signed in
+        admin """
+    def dispatch(self):
+        headers = self.request.headers
+        if 'X-AppEngine-TaskName' not in headers and 'X-AppEngine-Cron' not in headers and \
+                not users.is_current_user_admin():
+            self.abort(403)
+        webapp2.RequestHandler.dispatch(self)
+
+class Warmup(webapp2.RequestHandler):
+    """ /_ah/warmup, imports the handler modules and compiles the templates
+        before the instance is given its first request """
     def get(self):
-        if self.request.get('arg'):
-            url = self.request.get('arg')
-            self.redirect('/' + url)
-        else:
-            self.redirect('/')
-
-class DeleteHandler(webapp2.RequestHandler):
-    """ delete image question or answers """
-    def post(self):
-        if not users.is_current_user_admin():
-            signUrl = users.create_logout_url('/')
-            self.redirect(signUrl)
-        
-        if self.request.get('qid'):
-            qid = self.request.get('qid')
-            try:
-                questionKey = ndb.Key(urlsafe = qid)
-            except:
-                self.redirect('/')
-                return
-            question = questionKey.get()
-            answers = Answer.query(ancestor=questionKey).fetch()
-            for answer in answers:
-                answer.key.delete()
-            votes = Vote.query(ancestor=questionKey).fetch()
-            for vote in votes:
-                vote.key.delete()
-            question.key.delete()
-            self.redirect('/')
-        elif self.request.get('aid'):
-            aid=self.request.get('aid')
-            try:
-                answerKey = ndb.Key(urlsafe = aid)
-            except:
-                self.redirect('/')
-                return
-            answer = answerKey.get()
-            questionKey = answerKey.parent()
-            votes = Vote.query(ancestor=answerKey).fetch()
-            for vote in votes:
-                vote.key.delete()
-            answer.key.delete()
-            self.redirect('/view?qid=' + questionKey.urlsafe())
-        elif self.request.get('imgid'):
-            imgid=self.request.get('imgid')
-            image = blobstore.BlobInfo.get(imgid)
-            image.delete()
-            self.redirect('/image')
-        else:
-            self.redirect('/')   
-                    
-    
-application = webapp2.WSGIApplication([
-    ('/', MainPage),
-    ('/create', AddQuestionPage),
-    ('/question', AddQuestion),
-    ('/view', ViewQuestion),
-    ('/answer', AnswerQuestion),
-    ('/list', MainPage),
-    ('/vote', AddVote),
-    ('/editq', EditQuestion),
-    ('/edita', EditAnswer),
-    ('/tags', GetTagsPage),
-    ('/rss', RssPage),
-    ('/img/([^/]+)?', ImageHandler),
-    ('/image', GetImagesPage),
-    ('/uploadImage', UploadImageHandler),
-    ('/delete', DeleteHandler),
-    ('/redirect', RedirectHandler)
+        start = time.time()
+        for handler in set(route.handler for route in self.app.router.match_routes):
+            if isinstance(handler, basestring):
+                webapp2.import_string(handler)
+        imported = time.time()
+        for templateName in TEMPLATES:
+            jinjaEnvironment().get_template(templateName)
+        compiled = time.time()
+        message = 'question imported in %dms, handlers in %dms, templates in %dms' % (
+            IMPORT_TIME * 1000, (imported - start) * 1000, (compiled - imported) * 1000)
+        logging.info(message)
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write(message)
+
+def dispatcher(router, request, response):
+    """ instrumented dispatch, the writes a handler leaves pending are
+        committed before its response goes out """
+    return unitofwork.run(instrument.dispatcher, router, request, response)
+
+#handlers are named by their module, the router imports it on the first request
+#to one of its routes, /_ah/warmup imports them all ahead of traffic
+app = webapp2.WSGIApplication([
+    ('/', 'pages.MainPage'),
+    ('/create', 'posts.AddQuestionPage'),
+    ('/question', 'posts.AddQuestion'),
+    ('/view', 'pages.ViewQuestion'),
+    ('/answer', 'posts.AnswerQuestion'),
+    ('/list', 'pages.MainPage'),
+    ('/vote', 'posts.AddVote'),
+    ('/editq', 'posts.EditQuestion'),
+    ('/edita', 'posts.EditAnswer'),
+    ('/tags', 'pages.GetTagsPage'),
+    ('/rss', 'pages.RssPage'),
+    ('/img/([^/]+)/([^/]+)', 'imagepages.ImageHandler'),
+    ('/img/([^/]+)?', 'imagepages.ImageHandler'),
+    ('/image', 'imagepages.GetImagesPage'),
+    ('/uploadImage', 'imagepages.UploadImageHandler'),
+    ('/delete', 'posts.DeleteHandler'),
+    ('/redirect', 'pages.RedirectHandler'),
+    ('/admin/rebuildtags', 'admin.RebuildTagIndex'),
+    ('/admin/aggregatevotes', 'admin.AggregateVotes'),
+    ('/admin/migratevotes', 'admin.MigrateVotes'),
+    ('/admin/migratequestions', 'admin.MigrateQuestions'),
+    ('/admin/tags/delta', 'admin.ApplyTagDelta'),
+    ('/admin/renderbackfill', 'admin.RenderBackfill'),
+    ('/admin/purge', 'admin.PurgeHandler'),
+    ('/admin/notify/answer', 'admin.NotifyAnswer'),
+    ('/admin/notify/digest', 'admin.SendDigest'),
+    ('/search', 'pages.SearchPage'),
+    ('/admin/search/index', 'admin.IndexQuestion'),
+    ('/admin/search/rebuild', 'admin.RebuildSearchIndex'),
+    ('/admin/summarybackfill', 'admin.SummaryBackfill'),
+    ('/admin/images/derive', 'imagepages.DeriveImages'),
+    ('/stats', 'admin.StatsPage'),
+    ('/_ah/warmup', Warmup)
 ], debug=True)
+app.router.set_dispatcher(dispatcher)
+
+#ndb.toplevel makes every request wait for its outstanding async RPCs
+application = instrument.Instrument(ndb.toplevel(app))
+
+IMPORT_TIME = time.time() - IMPORT_START
+logging.info('question imported in %dms', IMPORT_TIME * 1000)
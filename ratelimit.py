@@ -0,0 +1,109 @@
+"""Token bucket rate limits.
+
+A limiter allows a burst of `capacity` actions per key, refilled evenly
+over `per` seconds. MemoryLimiter keeps its buckets in the instance,
+MemcacheLimiter shares them between instances through memcache with
+compare-and-set. Neither touches the datastore, so a rejected request
+costs no datastore RPC. Every rejection is counted per limiter name for
+the /stats page.
+"""
+import collections
+import math
+import threading
+import time
+
+CAS_RETRIES = 3
+
+_lock = threading.Lock()
+_rejections = collections.Counter() #limiter name -> rejected requests on this instance
+
+
+def rejections():
+    """ rejected requests per limiter name, sorted by name """
+    with _lock:
+        return sorted(_rejections.items())
+
+
+def reset():
+    with _lock:
+        _rejections.clear()
+
+
+class Limiter(object):
+    """ the bucket arithmetic, subclasses store the (tokens, time) state """
+
+    def __init__(self, name, capacity, per):
+        self.name = name
+        self.capacity = capacity
+        self.rate = float(capacity) / per
+
+    def refill(self, state, now):
+        """ the tokens of a bucket in state at time now """
+        if state is None:
+            return self.capacity
+        tokens, last = state
+        return min(self.capacity, tokens + (now - last) * self.rate)
+
+    def reject(self, tokens):
+        """ count a rejection, returns the whole seconds until a token is back """
+        with _lock:
+            _rejections[self.name] += 1
+        return max(1, int(math.ceil((1 - tokens) / self.rate)))
+
+
+class MemoryLimiter(Limiter):
+    """ buckets in this instance, the least recently used beyond size are
+        dropped and come back full """
+
+    def __init__(self, name, capacity, per, size=10000):
+        Limiter.__init__(self, name, capacity, per)
+        self.size = size
+        self.buckets = collections.OrderedDict() #key -> (tokens, last refill)
+        self.lock = threading.Lock()
+
+    def take(self, key):
+        """ take a token for key, returns 0, or the seconds until one is available """
+        now = time.time()
+        with self.lock:
+            tokens = self.refill(self.buckets.pop(key, None), now)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+        if allowed:
+            return 0
+        return self.reject(tokens)
+
+
+class MemcacheLimiter(Limiter):
+    """ buckets in memcache, shared by every instance, an evicted bucket
+        comes back full """
+
+    def __init__(self, name, capacity, per, namespace='ratelimit'):
+        from google.appengine.api import memcache
+        Limiter.__init__(self, name, capacity, per)
+        self.ttl = int(math.ceil(per)) #an untouched bucket is full again by then
+        self.client = memcache.Client()
+        self.namespace = namespace
+
+    def take(self, key):
+        """ take a token for key, returns 0, or the seconds until one is available """
+        key = self.name + ':' + key
+        for attempt in range(CAS_RETRIES):
+            now = time.time()
+            state = self.client.gets(key, namespace=self.namespace)
+            tokens = self.refill(state, now)
+            if tokens < 1:
+                return self.reject(tokens)
+            if state is None:
+                stored = self.client.add(key, (tokens - 1, now), time=self.ttl,
+                                         namespace=self.namespace)
+            else:
+                stored = self.client.cas(key, (tokens - 1, now), time=self.ttl,
+                                         namespace=self.namespace)
+            if stored:
+                return 0
+        #only the same key's own requests race here, a flood of them is turned away
+        return self.reject(0)
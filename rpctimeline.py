@@ -0,0 +1,83 @@
+"""Per-request timeline of App Engine API calls.
+
+Hooks into the apiproxy to note when every RPC of the current request
+starts and finishes, so overlapping async calls show up as overlapping
+spans. The instrument middleware begins and ends the timeline of every
+request.
+"""
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+_local = threading.local()
+
+
+class Timeline(object):
+    """ the RPC spans of one request, offsets in seconds from its start """
+
+    def __init__(self):
+        self.start = time.time()
+        self.pending = {}
+        self.spans = [] #(name, started at, duration)
+
+    def begin(self, rpc, name):
+        self.pending[id(rpc)] = (name, time.time())
+
+    def end(self, rpc):
+        name, started = self.pending.pop(id(rpc), (None, None))
+        if name is not None:
+            self.spans.append((name, started - self.start, time.time() - started))
+
+    def rpcTime(self):
+        """ total time spent waiting on RPCs, overlapping spans counted once """
+        total = 0.0
+        reach = 0.0
+        for name, offset, duration in sorted(self.spans, key=lambda span: span[1]):
+            total += max(0.0, offset + duration - max(offset, reach))
+            reach = max(reach, offset + duration)
+        return total
+
+    def format(self):
+        return '; '.join('%s +%dms %dms' % (name, offset * 1000, duration * 1000)
+                         for name, offset, duration in self.spans)
+
+
+def current():
+    """ the timeline of the request running on this thread, or None """
+    return getattr(_local, 'timeline', None)
+
+
+def _preCall(service, call, request, response, rpc):
+    timeline = current()
+    if timeline is not None:
+        timeline.begin(rpc, service + '.' + call)
+
+
+def _postCall(service, call, request, response, rpc, error):
+    timeline = current()
+    if timeline is not None:
+        timeline.end(rpc)
+
+
+def install():
+    """ register the apiproxy hooks, once per instance """
+    if getattr(install, 'done', False):
+        return
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('rpctimeline', _preCall)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('rpctimeline', _postCall)
+    install.done = True
+
+
+def begin():
+    """ start the timeline of the request about to run on this thread """
+    install()
+    _local.timeline = Timeline()
+    return _local.timeline
+
+
+def end():
+    """ stop recording and return the timeline of this thread's request """
+    timeline = current()
+    _local.timeline = None
+    return timeline
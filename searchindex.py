@@ -0,0 +1,84 @@
+"""Full text search over questions and their answers.
+
+Every question is one document in the App Engine Search API index, holding
+its title, content, tags and the content of all its answers. Results are
+ranked by term relevance plus bounded bonuses for the question's votes and
+recency, so neither can outweigh a much better match.
+"""
+import calendar
+import re
+import time
+
+from google.appengine.api import search
+
+INDEX_NAME = 'questions'
+RESULTS_PER_PAGE = 10
+MAX_TERMS = 20
+MAX_ANSWERS_TEXT = 500000 #characters of answer text kept per document
+#MatchScorer's _score is mostly below 1, each bonus adds at most half that
+VOTE_WEIGHT = 0.05 #rank points per net vote
+VOTE_CAP = 10 #net votes counted, either way
+RECENCY_WEIGHT = 0.5 #rank points of a question updated today
+RECENCY_DAYS = 30 #age in days at which the recency points have halved
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def getIndex():
+    return search.Index(name=INDEX_NAME)
+
+
+def tokenize(s):
+    """ the search terms of a user query, lower cased, syntax stripped """
+    return [term.lower() for term in TERM_RE.findall(s)][:MAX_TERMS]
+
+
+def buildDocument(question, answers):
+    """ the search document of a question with its answers """
+    updated = max([question.modifyTime] + [answer.modifyTime for answer in answers])
+    answersText = u'\n'.join(answer.content for answer in answers)[:MAX_ANSWERS_TEXT]
+    fields = [
+        search.TextField(name='title', value=question.handle or u''),
+        search.TextField(name='content', value=question.content),
+        search.TextField(name='answers', value=answersText),
+        search.NumberField(name='votes', value=question.voteResult or 0),
+        search.NumberField(name='days', value=calendar.timegm(updated.timetuple()) // 86400),
+    ]
+    fields.extend(search.AtomField(name='tag', value=tag) for tag in question.tags)
+    return search.Document(doc_id=question.key.urlsafe(), fields=fields)
+
+
+def put(documents):
+    if documents:
+        getIndex().put(documents)
+
+
+def delete(docIds):
+    if docIds:
+        getIndex().delete(docIds)
+
+
+def query(terms, cursor=None):
+    """ returns (question urlsafe keys, next page web safe cursor or None) """
+    if not terms:
+        return [], None
+    #days holds the day of the last update, its age decays the recency points
+    today = int(time.time()) // 86400
+    rank = search.SortExpression(
+        expression='_score + %f * max(-%d, min(%d, votes)) + %f / (1 + max(0, %d - days) / %f)' % (
+            VOTE_WEIGHT, VOTE_CAP, VOTE_CAP, RECENCY_WEIGHT, today, float(RECENCY_DAYS)),
+        direction=search.SortExpression.DESCENDING,
+        default_value=0)
+    options = search.QueryOptions(
+        limit=RESULTS_PER_PAGE,
+        cursor=search.Cursor(web_safe_string=cursor) if cursor else search.Cursor(),
+        ids_only=True,
+        sort_options=search.SortOptions(
+            expressions=[rank],
+            match_scorer=search.MatchScorer()))
+    results = getIndex().search(search.Query(query_string=u' '.join(terms), options=options))
+    if results.cursor:
+        nextCursor = results.cursor.web_safe_string
+    else:
+        nextCursor = None
+    return [document.doc_id for document in results.results], nextCursor
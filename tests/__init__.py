@@ -0,0 +1,16 @@
+"""Unit tests, the datastore, task queue and request handling ones on the
+App Engine testbed stubs.
+
+They need the App Engine SDK, found through $GAE_SDK like benchmark.py:
+
+    GAE_SDK=~/google-cloud-sdk/platform/google_appengine python -m unittest discover -s tests -t .
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import bulkdata
+bulkdata.setupSdk(None)
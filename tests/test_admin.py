@@ -0,0 +1,73 @@
+import unittest
+
+import webob
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from tests import ROOT
+
+HOST = 'forum.example.com'
+
+
+class JobAccessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(http_host=HOST, user_email='', user_id='', user_is_admin='0',
+                               overwrite=True)
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_user_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().set_cache_policy(False)
+        import question
+        self.question = question
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def call(self, method, path, headers=None):
+        request = webob.Request.blank(path, environ={'REQUEST_METHOD': method, 'HTTP_HOST': HOST},
+                                      headers=headers or {})
+        return request.get_response(self.question.application)
+
+    def testSignedOutRequestIsRefused(self):
+        self.assertEqual(self.call('GET', '/admin/rebuildtags').status_int, 403)
+        self.assertEqual(self.call('POST', '/admin/summarybackfill').status_int, 403)
+        self.assertIsNone(self.question.tag_rebuild_key().get())
+
+    def testSignedInUserIsRefused(self):
+        self.testbed.setup_env(user_email='user@example.com', user_id='1', user_is_admin='0',
+                               overwrite=True)
+        self.assertEqual(self.call('GET', '/admin/rebuildtags').status_int, 403)
+
+    def testCronRuns(self):
+        response = self.call('GET', '/admin/rebuildtags', {'X-AppEngine-Cron': 'true'})
+        self.assertEqual(response.status_int, 200)
+        self.assertIsNotNone(self.question.tag_rebuild_key().get())
+        self.assertEqual(len(self.taskqueue.get_filtered_tasks(queue_names=['tagindex'])), 1)
+        response = self.call('GET', '/admin/aggregatevotes', {'X-AppEngine-Cron': 'true'})
+        self.assertEqual(response.status_int, 200)
+
+    def testTaskRuns(self):
+        response = self.call('POST', '/admin/summarybackfill', {'X-AppEngine-TaskName': 'backfill'})
+        self.assertEqual(response.status_int, 200)
+
+    def testAdminRuns(self):
+        self.testbed.setup_env(user_email='admin@example.com', user_id='2', user_is_admin='1',
+                               overwrite=True)
+        self.assertEqual(self.call('GET', '/admin/summarybackfill').status_int, 200)
+
+    def testTagDeltaNeedsATaskName(self):
+        self.testbed.setup_env(user_email='admin@example.com', user_id='2', user_is_admin='1',
+                               overwrite=True)
+        self.assertEqual(self.call('POST', '/admin/tags/delta').status_int, 403)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import datetime
+import unittest
+
+from google.appengine.api import users
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+
+class AnswerSummaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        ndb.get_context().set_cache_policy(False)
+        import question
+        self.question = question
+        self.start = datetime.datetime(2020, 1, 1)
+        self.questionKey = question.Question(modifyTime=self.start, lastActivity=self.start,
+                                             version=1).put()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def answer(self, minutes, author):
+        answer = self.question.Answer(parent=self.questionKey, content='answer',
+                                      author=users.User('%s@example.com' % author),
+                                      modifyTime=self.start + datetime.timedelta(minutes=minutes))
+        self.question.saveAnswer(answer)
+        return answer.key
+
+    def summary(self):
+        question = self.questionKey.get()
+        author = question.lastAnswerAuthor and question.lastAnswerAuthor.email()
+        return question.answerCount, question.lastAnswerTime, author, question.version
+
+    def at(self, minutes):
+        return self.start + datetime.timedelta(minutes=minutes)
+
+    def testNewAnswersUpdateTheSummary(self):
+        self.answer(5, 'a')
+        self.assertEqual(self.summary(), (1, self.at(5), 'a@example.com', 2))
+        self.answer(9, 'b')
+        self.assertEqual(self.summary(), (2, self.at(9), 'b@example.com', 3))
+        self.assertEqual(self.questionKey.get().lastActivity, self.at(9))
+
+    def testEditKeepsTheCountAndFoldedVotes(self):
+        key = self.answer(5, 'a')
+        edited = key.get()
+        #votes folded while the answer was being edited
+        stored = key.get()
+        stored.voteResult = 3
+        stored.put()
+        edited.content = 'edited'
+        edited.modifyTime = self.at(7)
+        self.question.saveAnswer(edited)
+        self.assertEqual(self.summary(), (1, self.at(5), 'a@example.com', 3))
+        self.assertEqual(self.questionKey.get().lastActivity, self.at(7))
+        self.assertEqual((key.get().content, key.get().voteResult), ('edited', 3))
+
+    def testDeleteFallsBackToTheNewestAnswerLeft(self):
+        first = self.answer(5, 'a')
+        second = self.answer(9, 'b')
+        self.question.deleteAnswer(second)
+        self.assertEqual(self.summary(), (1, self.at(5), 'a@example.com', 4))
+        self.question.deleteAnswer(first)
+        self.assertEqual(self.summary(), (0, None, None, 5))
+        self.assertIsNone(first.get())
+
+    def testRepeatedDeleteCountsOnce(self):
+        self.answer(5, 'a')
+        key = self.answer(9, 'b')
+        self.assertIsNotNone(self.question.deleteAnswer(key))
+        self.assertIsNone(self.question.deleteAnswer(key))
+        self.assertEqual(self.summary()[0], 1)
+
+    def testAnswerOfADeletedQuestionIsDeleted(self):
+        key = self.answer(5, 'a')
+        self.questionKey.delete()
+        self.assertIsNone(self.question.deleteAnswer(key))
+        self.assertIsNone(key.get())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import io
+import unittest
+
+import bulkdata
+
+
+class ChunkTest(unittest.TestCase):
+
+    def chunks(self, data, offset=0):
+        return list(bulkdata.readChunks(io.BytesIO(data), offset))
+
+    def testChunksReadBackWithTheirOffsets(self):
+        first = bulkdata.compressChunk(['[1]', '[2]'])
+        second = bulkdata.compressChunk([u'["\u00e9"]'])
+        chunks = self.chunks(first + second)
+        self.assertEqual(chunks, [(['[1]', '[2]'], len(first)),
+                                  ([u'["\u00e9"]'], len(first) + len(second))])
+
+    def testReadResumesAtAnOffset(self):
+        first = bulkdata.compressChunk(['[1]'])
+        second = bulkdata.compressChunk(['[2]'])
+        self.assertEqual(self.chunks(first + second, len(first)),
+                         [(['[2]'], len(first) + len(second))])
+
+    def testEmptyChunk(self):
+        chunk = bulkdata.compressChunk([])
+        self.assertEqual(self.chunks(chunk), [([], len(chunk))])
+
+    def testChunkLargerThanOneRead(self):
+        lines = ['[%d,"%s"]' % (i, bulkdata.os.urandom(16).encode('hex')) for i in range(5000)]
+        chunk = bulkdata.compressChunk(lines)
+        self.assertGreater(len(chunk), bulkdata.READ_SIZE)
+        self.assertEqual(self.chunks(chunk), [(lines, len(chunk))])
+
+    def testCutChunkIsRejected(self):
+        first = bulkdata.compressChunk(['[1]'])
+        second = bulkdata.compressChunk(['[2]', '[3]'])
+        with self.assertRaises(ValueError):
+            self.chunks(first + second[:len(second) // 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import unittest
+
+import instrument
+
+
+class PercentileTest(unittest.TestCase):
+
+    def testEmpty(self):
+        self.assertEqual(instrument.percentile([], 50), 0)
+
+    def testOneValue(self):
+        self.assertEqual(instrument.percentile([7], 99), 7)
+
+    def testNearestRank(self):
+        values = range(1, 102) #1..101
+        self.assertEqual(instrument.percentile(values, 0), 1)
+        self.assertEqual(instrument.percentile(values, 50), 51)
+        self.assertEqual(instrument.percentile(values, 90), 91)
+        self.assertEqual(instrument.percentile(values, 100), 101)
+
+    def testRoundsToTheNearestIndex(self):
+        self.assertEqual(instrument.percentile([1, 2, 3, 4], 50), 3)
+        self.assertEqual(instrument.percentile([1, 2, 3, 4], 40), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+
+import linkrender
+
+HOST = 'forum.example.com'
+
+
+class LinkRendererTest(unittest.TestCase):
+
+    def testLinkBecomesAnchor(self):
+        self.assertEqual(linkrender.FULL.render('see http://a.org/x, thanks', HOST),
+                         'see <a href="http://a.org/x">a.org/x</a>, thanks')
+
+    def testImageUrlBecomesImage(self):
+        self.assertEqual(linkrender.FULL.render('https://a.org/cat.png', HOST),
+                         '<img src="https://a.org/cat.png">')
+
+    def testUploadedImageKeepsItsUrl(self):
+        self.assertEqual(linkrender.FULL.render('http://%s/img/blob' % HOST, HOST),
+                         '<img src="http://%s/img/blob">' % HOST)
+
+    def testThumbnailPointsAtTheVariant(self):
+        self.assertEqual(linkrender.THUMBNAIL.render('http://%s/img/blob' % HOST, HOST),
+                         '<img src="http://%s/img/blob/thumb" height="50" width="50">' % HOST)
+
+    def testThumbnailLeavesAVariantAlone(self):
+        self.assertEqual(linkrender.THUMBNAIL.render('http://%s/img/blob/preview' % HOST, HOST),
+                         '<img src="http://%s/img/blob/preview" height="50" width="50">' % HOST)
+
+    def testOtherHostsImageIsNotAnUpload(self):
+        self.assertEqual(linkrender.THUMBNAIL.render('http://other.org/img/blob', HOST),
+                         '<a href="http://other.org/img/blob">other.org/img/blob</a>')
+
+
+class TruncateTest(unittest.TestCase):
+
+    def testShortTextIsKept(self):
+        self.assertEqual(linkrender.truncate('a few words', 20), 'a few words')
+
+    def testCutOnAWordBoundary(self):
+        self.assertEqual(linkrender.truncate('one two three four', 10), 'one two ...')
+
+    def testExcerptRendersTheTruncatedText(self):
+        text = 'http://a.org ' + 'word ' * 200
+        excerpt = linkrender.renderExcerpt(text, HOST)
+        self.assertTrue(excerpt.startswith('<a href="http://a.org">a.org</a> word'))
+        self.assertTrue(excerpt.endswith('...'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import time
+import unittest
+
+import pagecache
+
+
+class MemoryStoreTest(unittest.TestCase):
+
+    def testExpiredEntryIsMissing(self):
+        store = pagecache.MemoryStore()
+        store.set_multi({'a': 1, 'b': 2}, ttl=60)
+        store.entries['a'] = (time.time() - 1, 1)
+        self.assertEqual(store.get_multi(['a', 'b']), {'b': 2})
+
+    def testLeastRecentlyUsedIsEvicted(self):
+        store = pagecache.MemoryStore(capacity=2)
+        store.set_multi({'a': 1})
+        store.set_multi({'b': 2})
+        store.get_multi(['a'])
+        store.set_multi({'c': 3})
+        self.assertEqual(store.get_multi(['a', 'b', 'c']), {'a': 1, 'c': 3})
+
+
+class PageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = pagecache.MemoryStore()
+        self.cache = pagecache.PageCache(self.store)
+
+    def put(self, key, groups, page):
+        cached, token = self.cache.get(key, groups)
+        self.cache.set(token, page)
+
+    def get(self, key, groups):
+        return self.cache.get(key, groups)[0]
+
+    def testGetReturnsWhatWasSet(self):
+        self.put(('list', 1), ['list'], 'page')
+        self.assertEqual(self.get(('list', 1), ['list']), 'page')
+        self.assertIsNone(self.get(('list', 2), ['list']))
+
+    def testInvalidateDropsPagesOfTheGroup(self):
+        self.put('main', ['list'], 'main page')
+        self.put('thread', ['view:q1'], 'thread page')
+        self.cache.invalidate('list')
+        self.assertIsNone(self.get('main', ['list']))
+        self.assertEqual(self.get('thread', ['view:q1']), 'thread page')
+
+    def testPageOfSeveralGroupsGoesWithAnyOfThem(self):
+        self.put('tagged', ['list:a', 'list:b'], 'page')
+        self.cache.invalidate('list:b')
+        self.assertIsNone(self.get('tagged', ['list:a', 'list:b']))
+
+    def testPageSetAfterInvalidateIsCached(self):
+        self.cache.invalidate('list')
+        self.put('main', ['list'], 'new page')
+        self.assertEqual(self.get('main', ['list']), 'new page')
+
+    def testInvalidateBetweenGetAndSetIsKept(self):
+        #the page was built from data read before the invalidation
+        cached, token = self.cache.get('main', ['list'])
+        self.cache.invalidate('list')
+        self.cache.set(token, 'stale page')
+        self.assertIsNone(self.get('main', ['list']))
+
+    def testEvictedVersionDoesNotRevivePages(self):
+        self.put('main', ['list'], 'old page')
+        del self.store.entries['v:list']
+        self.assertIsNone(self.get('main', ['list']))
+
+
+if __name__ == '__main__':
+    unittest.main()
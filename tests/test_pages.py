@@ -0,0 +1,101 @@
+import datetime
+import unittest
+
+import webob
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from tests import ROOT
+
+HOST = 'forum.example.com'
+
+
+class PageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(http_host=HOST, user_email='', user_id='', user_is_admin='0',
+                               overwrite=True)
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_user_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        ndb.get_context().set_cache_policy(False)
+        import question
+        self.question = question
+        #the page cache lives as long as the process
+        question.PAGE_CACHE.store.entries.clear()
+        self.save(['a'])
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def save(self, tags, handle='q'):
+        question = self.question.Question(handle=handle, content='question', tags=tags,
+                                          modifyTime=datetime.datetime.now())
+        key = self.question.saveQuestion(question)
+        self.question.invalidateQuestion(key, tags)
+        return key
+
+    def get(self, path, etag=None):
+        headers = {'If-None-Match': etag} if etag else {}
+        request = webob.Request.blank(path, environ={'HTTP_HOST': HOST}, headers=headers)
+        return request.get_response(self.question.application)
+
+    def dropCachedPages(self):
+        entries = self.question.PAGE_CACHE.store.entries
+        for key in list(entries):
+            if not key.startswith('v:'):
+                del entries[key]
+
+
+class ListEtagTest(PageTest):
+
+    def testRevalidationNeedsNoCachedPageNorQuery(self):
+        etag = self.get('/list?tag=a').etag
+        self.dropCachedPages()
+        #Question inherits query from ndb.Model
+        self.addCleanup(delattr, self.question.Question, 'query')
+
+        def failQuery(*args, **kwargs):
+            self.fail('the list was queried')
+        self.question.Question.query = staticmethod(failQuery)
+        response = self.get('/list?tag=a', etag)
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.etag, etag)
+
+    def testWriteToTheListChangesTheEtag(self):
+        etag = self.get('/list?tag=a').etag
+        self.save(['b'])
+        self.assertEqual(self.get('/list?tag=a', etag).status_int, 304)
+        self.save(['a'])
+        response = self.get('/list?tag=a', etag)
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.etag, etag)
+
+    def testListsOfOtherParamsHaveOtherEtags(self):
+        etags = set(self.get(path).etag for path in ('/list', '/list?tag=a', '/list?order=top',
+                                                     '/list?tag=a&order=top'))
+        self.assertEqual(len(etags), 4)
+
+
+
+class TagListTest(PageTest):
+
+    def testTagsNeverUsedTogetherListNothing(self):
+        self.save(['a', 'c'], 'tagged both')
+        #the tag index update is still queued
+        self.assertNotIn('tagged both', self.get('/list?tag=a+c').body)
+        self.question.TagPair(key=self.question.tag_pair_key('a', 'c'), tags=['a', 'c'],
+                              count=1).put()
+        self.dropCachedPages()
+        self.assertIn('tagged both', self.get('/list?tag=a+c').body)
+        self.assertIn('tagged both', self.get('/list?tag=c').body)
+
+
+if __name__ == '__main__':
+    unittest.main()
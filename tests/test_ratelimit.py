@@ -0,0 +1,55 @@
+import time
+import unittest
+
+import ratelimit
+
+
+class LimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        ratelimit.reset()
+        self.limiter = ratelimit.Limiter('test', 4, 60) #one token per 15 seconds
+
+    def testNewBucketIsFull(self):
+        self.assertEqual(self.limiter.refill(None, 100.0), 4)
+
+    def testRefillIsEvenOverPer(self):
+        self.assertAlmostEqual(self.limiter.refill((0.0, 100.0), 130.0), 2.0)
+
+    def testRefillStopsAtCapacity(self):
+        self.assertEqual(self.limiter.refill((3.0, 100.0), 1000.0), 4)
+
+    def testRejectReturnsSecondsUntilAToken(self):
+        self.assertEqual(self.limiter.reject(0.0), 15)
+        self.assertEqual(self.limiter.reject(0.5), 8)
+        self.assertEqual(self.limiter.reject(0.99), 1)
+        self.assertEqual(ratelimit.rejections(), [('test', 3)])
+
+
+class MemoryLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        ratelimit.reset()
+        self.limiter = ratelimit.MemoryLimiter('test', 2, 60)
+
+    def testBurstThenRejection(self):
+        self.assertEqual(self.limiter.take('user'), 0)
+        self.assertEqual(self.limiter.take('user'), 0)
+        self.assertEqual(self.limiter.take('user'), 30)
+        self.assertEqual(self.limiter.take('other'), 0)
+        self.assertEqual(ratelimit.rejections(), [('test', 1)])
+
+    def testEmptyBucketRefills(self):
+        self.limiter.buckets['user'] = (0.0, time.time() - 45)
+        self.assertEqual(self.limiter.take('user'), 0)
+        self.assertNotEqual(self.limiter.take('user'), 0)
+
+    def testEvictedBucketComesBackFull(self):
+        limiter = ratelimit.MemoryLimiter('test', 1, 60, size=1)
+        self.assertEqual(limiter.take('a'), 0)
+        self.assertEqual(limiter.take('b'), 0)
+        self.assertEqual(limiter.take('a'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
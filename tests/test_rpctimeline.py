@@ -0,0 +1,27 @@
+import unittest
+
+import rpctimeline
+
+
+class RpcTimeTest(unittest.TestCase):
+
+    def rpcTime(self, spans):
+        timeline = rpctimeline.Timeline()
+        timeline.spans = [('rpc', offset, duration) for offset, duration in spans]
+        return timeline.rpcTime()
+
+    def testNoSpans(self):
+        self.assertEqual(self.rpcTime([]), 0.0)
+
+    def testSeparateSpansAdd(self):
+        self.assertAlmostEqual(self.rpcTime([(0.0, 0.1), (0.3, 0.2)]), 0.3)
+
+    def testOverlapIsCountedOnce(self):
+        self.assertAlmostEqual(self.rpcTime([(0.2, 0.3), (0.0, 0.3)]), 0.5)
+
+    def testContainedSpanAddsNothing(self):
+        self.assertAlmostEqual(self.rpcTime([(0.0, 1.0), (0.2, 0.1), (0.5, 0.2)]), 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
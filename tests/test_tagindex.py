@@ -0,0 +1,177 @@
+import datetime
+import unittest
+
+import webob
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from tests import ROOT
+
+HOST = 'forum.example.com'
+
+
+class CountTagsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        import question
+        self.question = question
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testCountsTagsAndPairs(self):
+        rebuild = self.question.TagRebuild(counts={}, pairs={})
+        early = datetime.datetime(2020, 1, 1)
+        late = datetime.datetime(2020, 1, 2)
+        self.question.countTags(rebuild, ['b', 'a', 'a'], late)
+        self.question.countTags(rebuild, ['a'], early)
+        self.assertEqual(rebuild.counts, {'a': [2, late.strftime(self.question.TAG_DELTA_FORMAT)],
+                                          'b': [1, late.strftime(self.question.TAG_DELTA_FORMAT)]})
+        self.assertEqual(rebuild.pairs, {'a|b': ['a', 'b', 1]})
+
+    def testNegativeStepKeepsTheLastActivity(self):
+        rebuild = self.question.TagRebuild(counts={}, pairs={})
+        late = datetime.datetime(2020, 1, 2)
+        self.question.countTags(rebuild, ['a', 'b'], late)
+        self.question.countTags(rebuild, ['a', 'b'], None, -1)
+        self.assertEqual(rebuild.counts['a'], [0, late.strftime(self.question.TAG_DELTA_FORMAT)])
+        self.assertEqual(rebuild.pairs, {'a|b': ['a', 'b', 0]})
+
+
+class TagIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(http_host=HOST, overwrite=True)
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().set_cache_policy(False)
+        import question
+        self.question = question
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def save(self, tags, key=None):
+        question = key and key.get() or self.question.Question(key=key)
+        question.tags = tags
+        question.modifyTime = datetime.datetime.now()
+        return self.question.saveQuestion(question)
+
+    def tasks(self, url=None):
+        """ the queued tag index tasks for url, or all of them, oldest first.
+            Etas are whole seconds, tests that depend on the order of the
+            tasks run them by url """
+        return sorted([task for task in self.taskqueue.get_filtered_tasks(queue_names=['tagindex'])
+                       if url is None or task.url == url], key=lambda task: task.eta_posix)
+
+    def runTask(self, task, retry=False):
+        """ run task through the application the way the queue does """
+        if not retry:
+            self.taskqueue.DeleteTask('tagindex', task.name)
+        request = webob.Request.blank(task.url, environ={'REQUEST_METHOD': 'POST', 'HTTP_HOST': HOST},
+                                      headers={'X-AppEngine-TaskName': task.name,
+                                               'Content-Type': 'application/x-www-form-urlencoded'})
+        request.body = task.payload
+        self.assertEqual(request.get_response(self.question.application).status_int, 200)
+
+    def drain(self, url=None):
+        """ run the queued tasks, only those for url if given """
+        while self.tasks(url):
+            self.runTask(self.tasks(url)[0])
+
+    def recount(self):
+        request = webob.Request.blank('/admin/rebuildtags', environ={'HTTP_HOST': HOST},
+                                      headers={'X-AppEngine-Cron': 'true'})
+        self.assertEqual(request.get_response(self.question.application).status_int, 200)
+
+    def index(self):
+        site = self.question.site_key()
+        return (dict((tag.key.id(), tag.count) for tag in self.question.Tag.query(ancestor=site)),
+                dict((pair.key.id(), pair.count) for pair in self.question.TagPair.query(ancestor=site)))
+
+    def testDeltasFollowTheWrites(self):
+        key = self.save(['a', 'b'])
+        self.save(['b', 'c'])
+        self.drain()
+        self.assertEqual(self.index(), ({'a': 1, 'b': 2, 'c': 1}, {'a|b': 1, 'b|c': 1}))
+        self.save(['c'], key)
+        self.question.deleteQuestion(key)
+        self.drain()
+        self.assertEqual(self.index(), ({'b': 1, 'c': 1}, {'b|c': 1}))
+
+    def testRetriedDeltaAppliesOnce(self):
+        self.save(['a'])
+        task = self.tasks()[0]
+        self.runTask(task, retry=True)
+        self.runTask(task)
+        self.assertEqual(self.index(), ({'a': 1}, {}))
+
+    def testRecountRepairsTheIndex(self):
+        self.save(['a', 'b'])
+        self.save(['b'])
+        self.drain()
+        site = self.question.site_key()
+        ndb.put_multi([self.question.Tag(key=self.question.tag_key('b'), count=7),
+                       self.question.Tag(key=self.question.tag_key('z'), count=1),
+                       self.question.TagPair(key=self.question.tag_pair_key('b', 'z'),
+                                             tags=['b', 'z'], count=1)])
+        self.recount()
+        self.drain()
+        self.assertEqual(self.index(), ({'a': 1, 'b': 2}, {'a|b': 1}))
+        rebuild = self.question.tag_rebuild_key().get()
+        self.assertIsNone(rebuild.cursor)
+        self.assertEqual(self.question.TagDelta.query(ancestor=site).count(), 2)
+
+    def questions(self, count, tags):
+        """ count questions with ids in key order, their updates applied """
+        keys = [self.save(tags, ndb.Key(self.question.Question, i + 1)) for i in range(count)]
+        self.drain()
+        return keys
+
+    def batchSize(self, size):
+        import admin
+        self.addCleanup(setattr, admin, 'TAG_REBUILD_BATCH', admin.TAG_REBUILD_BATCH)
+        admin.TAG_REBUILD_BATCH = size
+
+    def testWritesDuringTheRecountAreCounted(self):
+        self.batchSize(1)
+        first, second, third = self.questions(3, ['a'])
+        self.recount()
+        #the recount reads the first question, then it and the third change
+        self.runTask(self.tasks('/admin/rebuildtags')[0])
+        self.save(['b'], first)
+        self.save(['a', 'b'], third)
+        self.drain('/admin/tags/delta')
+        self.drain('/admin/rebuildtags')
+        self.assertEqual(self.index(), ({'a': 2, 'b': 2}, {'a|b': 1}))
+
+    def testUpdateQueuedBeforeTheRecountReadIsNotCountedTwice(self):
+        first, = self.questions(1, ['a'])
+        self.save(['b'], first)
+        #the recount reads the new tags before the update runs
+        self.recount()
+        self.drain('/admin/rebuildtags')
+        self.assertEqual(self.index(), ({'b': 1}, {}))
+        self.drain()
+        self.assertEqual(self.index(), ({'b': 1}, {}))
+
+    def testUpdateQueuedAfterTheRecountIsApplied(self):
+        first, = self.questions(1, ['a'])
+        self.recount()
+        self.drain()
+        self.save(['b'], first)
+        self.drain()
+        self.assertEqual(self.index(), ({'b': 1}, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import datetime
+import unittest
+
+from google.appengine.api import users
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from tests import ROOT
+
+
+class MoveThreadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(http_host='forum.example.com', overwrite=True)
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_search_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().set_cache_policy(False)
+        import question
+        self.question = question
+        self.user = users.User('user1@example.com', _user_id='1')
+        self.other = users.User('user2@example.com', _user_id='2')
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def legacyThread(self, answers):
+        """ a question stored the old way, in the site group, with answers """
+        now = datetime.datetime.now()
+        question = self.question.Question(parent=self.question.site_key(), handle='old',
+                                          tags=['a'], modifyTime=now, lastActivity=now,
+                                          answerCount=answers, version=3)
+        questionKey = question.put()
+        answerKeys = [self.question.Answer(parent=questionKey, content='answer %d' % i,
+                                           modifyTime=now).put()
+                      for i in range(answers)]
+        return questionKey, answerKeys
+
+    def testThreadMovesUnderTheSameIds(self):
+        legacyKey, answerKeys = self.legacyThread(2)
+        self.assertTrue(self.question.moveThread(legacyKey))
+        movedKey = self.question.migrated_key(legacyKey)
+        self.assertEqual(movedKey.id(), legacyKey.id())
+        self.assertIsNone(movedKey.parent())
+        moved = movedKey.get()
+        self.assertEqual((moved.handle, moved.tags, moved.answerCount, moved.version),
+                         ('old', ['a'], 2, 3))
+        self.assertEqual(ndb.get_multi([legacyKey] + answerKeys), [None, None, None])
+        movedAnswers = ndb.get_multi([self.question.migrated_key(key) for key in answerKeys])
+        self.assertEqual([answer.content for answer in movedAnswers], ['answer 0', 'answer 1'])
+
+    def testVotesFollowTheThread(self):
+        legacyKey, answerKeys = self.legacyThread(1)
+        #a vote from before votes moved to their voter, and one from after
+        old = self.question.Vote(parent=answerKeys[0], author=self.user, value='Up').put()
+        new = self.question.Vote(key=self.question.vote_key(self.other, legacyKey),
+                                 author=self.other, value='Down', target=legacyKey,
+                                 question=legacyKey).put()
+        #the datastore gives stored users their own ids
+        user, other = [vote.author for vote in ndb.get_multi([old, new])]
+        self.question.moveThread(legacyKey)
+        self.assertEqual(ndb.get_multi([old, new]), [None, None])
+        movedAnswer = self.question.migrated_key(answerKeys[0])
+        movedKey = self.question.migrated_key(legacyKey)
+        vote = self.question.vote_key(user, movedAnswer).get()
+        self.assertEqual((vote.value, vote.target, vote.question), ('Up', movedAnswer, movedKey))
+        vote = self.question.vote_key(other, movedKey).get()
+        self.assertEqual((vote.value, vote.target, vote.question), ('Down', movedKey, movedKey))
+
+    def testLegacyLinksResolveToTheMovedThread(self):
+        legacyKey, answerKeys = self.legacyThread(1)
+        self.assertEqual(self.question.resolveKey(legacyKey), legacyKey)
+        self.question.moveThread(legacyKey)
+        self.assertEqual(self.question.resolveKey(legacyKey), self.question.migrated_key(legacyKey))
+        self.assertEqual(self.question.resolveKey(answerKeys[0]),
+                         self.question.migrated_key(answerKeys[0]))
+
+    def testThreadWithATakenIdStays(self):
+        legacyKey, answerKeys = self.legacyThread(1)
+        self.question.Question(key=self.question.migrated_key(legacyKey), handle='new').put()
+        self.assertFalse(self.question.moveThread(legacyKey))
+        self.assertEqual(legacyKey.get().handle, 'old')
+        self.assertIsNotNone(answerKeys[0].get())
+        #links to the thread that stayed must not lead to the other one
+        self.assertEqual(self.question.resolveKey(legacyKey), legacyKey)
+
+    def testCopyRefusesAThreadWrittenSinceItWasRead(self):
+        legacyKey, answerKeys = self.legacyThread(1)
+        self.assertIsNone(self.question.copyThread(legacyKey, 2, answerKeys))
+        self.assertIsNotNone(legacyKey.get())
+        self.assertIsNone(self.question.migrated_key(legacyKey).get())
+        self.assertIsNotNone(self.question.copyThread(legacyKey, 3, answerKeys))
+        self.assertIsNone(legacyKey.get())
+
+    def testLargeThreadMovesInBatches(self):
+        self.addCleanup(setattr, self.question, 'MOVE_ANSWERS', self.question.MOVE_ANSWERS)
+        self.question.MOVE_ANSWERS = 2
+        legacyKey, answerKeys = self.legacyThread(5)
+        self.assertTrue(self.question.moveThread(legacyKey))
+        self.assertIsNone(legacyKey.get())
+        moved = ndb.get_multi([self.question.migrated_key(key) for key in answerKeys])
+        self.assertNotIn(None, moved)
+        #the legacy answers are purged afterwards
+        purges = [task for task in self.taskqueue.get_filtered_tasks() if task.url == '/admin/purge']
+        self.assertEqual(len(purges), 1)
+
+    def testMissingThreadNeedsNoMove(self):
+        missing = ndb.Key(self.question.Question, 42, parent=self.question.site_key())
+        self.assertTrue(self.question.moveThread(missing))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import unittest
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import unitofwork
+
+from tests import ROOT
+
+
+class Item(ndb.Model):
+    value = ndb.IntegerProperty()
+
+
+class UnitOfWorkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().set_cache_policy(False)
+        #note whether every write of a commit ran in a transaction
+        self.writes = []
+        write = unitofwork.write
+
+        def recordWrite(puts, deletes):
+            self.writes.append((len(puts), len(deletes), ndb.in_transaction()))
+            write(puts, deletes)
+        unitofwork.write = recordWrite
+        self.addCleanup(setattr, unitofwork, 'write', write)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testCountGroups(self):
+        root = Item(key=ndb.Key(Item, 1))
+        child = Item(key=ndb.Key(Item, 2, parent=ndb.Key(Item, 1)))
+        other = Item(key=ndb.Key(Item, 3))
+        new = [Item(), Item()]
+        self.assertEqual(unitofwork.countGroups([root, child], []), 1)
+        self.assertEqual(unitofwork.countGroups([root, other], [ndb.Key(Item, 4)]), 3)
+        self.assertEqual(unitofwork.countGroups(new, [ndb.Key(Item, 2, parent=ndb.Key(Item, 1))]), 3)
+
+    def testFewGroupsCommitInOneTransaction(self):
+        work = unitofwork.UnitOfWork()
+        work.put(*[Item(key=ndb.Key(Item, i), value=i) for i in range(1, unitofwork.MAX_GROUPS)])
+        work.delete(ndb.Key(Item, 100))
+        work.commit()
+        self.assertEqual(self.writes, [(unitofwork.MAX_GROUPS - 1, 1, True)])
+        self.assertEqual(Item.query().count(), unitofwork.MAX_GROUPS - 1)
+
+    def testManyGroupsCommitWithoutTransaction(self):
+        work = unitofwork.UnitOfWork()
+        work.put(*[Item(key=ndb.Key(Item, i)) for i in range(1, unitofwork.MAX_GROUPS + 2)])
+        work.commit()
+        self.assertEqual(self.writes, [(unitofwork.MAX_GROUPS + 1, 0, False)])
+
+    def testSingleWriteNeedsNoTransaction(self):
+        work = unitofwork.UnitOfWork()
+        work.put(Item(value=1))
+        work.commit()
+        self.assertEqual(self.writes, [(1, 0, False)])
+
+    def testLastWriteOfAKeyWins(self):
+        key = ndb.Key(Item, 1)
+        Item(key=key, value=0).put()
+        work = unitofwork.UnitOfWork()
+        work.put(Item(key=key, value=1))
+        work.delete(key)
+        work.put(Item(key=ndb.Key(Item, 2), value=2))
+        work.commit()
+        self.assertIsNone(key.get())
+
+        work.delete(key)
+        work.put(Item(key=key, value=3))
+        work.put(Item(key=key, value=4))
+        work.commit()
+        self.assertEqual(key.get().value, 4)
+
+    def testNamedTaskIsAddedOnce(self):
+        work = unitofwork.UnitOfWork()
+        work.addTask(taskqueue.Task(name='once', url='/a'))
+        work.addTask(taskqueue.Task(name='once', url='/a'))
+        work.addTask(taskqueue.Task(url='/b'))
+        work.addTask(taskqueue.Task(url='/b'))
+        work.commit()
+        urls = sorted(task.url for task in self.taskqueue.get_filtered_tasks())
+        self.assertEqual(urls, ['/a', '/b', '/b'])
+
+    def testExistingNamedTaskDoesNotFailTheCommit(self):
+        taskqueue.add(name='done', url='/a')
+        work = unitofwork.UnitOfWork()
+        work.addTask(taskqueue.Task(name='done', url='/a'))
+        work.addTask(taskqueue.Task(url='/b'))
+        work.commit()
+        self.assertEqual(len(self.taskqueue.get_filtered_tasks()), 2)
+
+    def testCollectCallsOnceAfterTheWrites(self):
+        calls = []
+
+        def forget(items):
+            calls.append((items, Item.query().count()))
+        work = unitofwork.UnitOfWork()
+        work.collect(forget, 'a', 'b')
+        work.collect(forget, 'b', 'c')
+        work.put(Item(value=1))
+        work.commit()
+        self.assertEqual(calls, [(['a', 'b', 'c'], 1)])
+
+    def testRunWritesNothingWhenTheHandlerFails(self):
+        def handler():
+            unitofwork.put(Item(value=1))
+            raise ValueError()
+        self.assertRaises(ValueError, unitofwork.run, handler)
+        self.assertEqual(Item.query().count(), 0)
+        self.assertIsNone(unitofwork.current())
+
+    def testWithoutAUnitWritesAtOnce(self):
+        unitofwork.put(Item(key=ndb.Key(Item, 1)))
+        self.assertIsNotNone(ndb.Key(Item, 1).get())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+
+from google.appengine.api import users
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from tests import ROOT
+
+
+class VoteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(http_host='forum.example.com', overwrite=True)
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        ndb.get_context().set_cache_policy(False)
+        import question
+        self.question = question
+        self.questionKey = question.Question(voteResult=2, version=1).put()
+        self.answerKey = question.Answer(parent=self.questionKey, voteResult=0).put()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def user(self, userId):
+        return users.User('user%d@example.com' % userId, _user_id=str(userId))
+
+    def pending(self, target):
+        shards = ndb.get_multi([self.question.vote_shard_key(target, i)
+                                for i in range(self.question.VOTE_SHARDS)])
+        return sum(shard.count for shard in shards if shard)
+
+    def testVoteAddsToAShard(self):
+        self.assertTrue(self.question.castVote(self.user(1), self.questionKey, 'Up'))
+        self.assertEqual(self.pending(self.questionKey), 1)
+        vote = self.question.vote_key(self.user(1), self.questionKey).get()
+        self.assertEqual(vote.value, 'Up')
+        self.assertEqual(vote.question, self.questionKey)
+
+    def testSameVoteTwiceIsRefused(self):
+        self.assertTrue(self.question.castVote(self.user(1), self.questionKey, 'Up'))
+        self.assertFalse(self.question.castVote(self.user(1), self.questionKey, 'Up'))
+        self.assertEqual(self.pending(self.questionKey), 1)
+
+    def testOppositeVoteCancels(self):
+        self.question.castVote(self.user(1), self.answerKey, 'Up')
+        self.assertTrue(self.question.castVote(self.user(1), self.answerKey, 'Down'))
+        self.assertEqual(self.pending(self.answerKey), 0)
+        self.assertEqual(self.question.vote_key(self.user(1), self.answerKey).get().value, 'none')
+
+    def testVoteOnAMissingTargetIsRejected(self):
+        missing = ndb.Key(self.question.Answer, 42, parent=self.questionKey)
+        self.assertIsNone(self.question.castVote(self.user(1), missing, 'Up'))
+        self.assertEqual(self.pending(missing), 0)
+        self.assertIsNone(self.question.vote_key(self.user(1), missing).get())
+
+    def testLegacyVoteCounts(self):
+        legacy = self.question.Vote(parent=self.questionKey, author=self.user(1), value='Up').put()
+        #an answer vote of the same user is another target
+        self.question.Vote(parent=self.answerKey, author=self.user(1), value='Down').put()
+        self.assertFalse(self.question.castVote(self.user(1), self.questionKey, 'Up'))
+        self.assertIsNotNone(legacy.get())
+        self.assertTrue(self.question.castVote(self.user(1), self.questionKey, 'Down'))
+        self.assertIsNone(legacy.get())
+        self.assertEqual(self.question.vote_key(self.user(1), self.questionKey).get().value, 'none')
+        self.assertEqual(self.pending(self.questionKey), -1)
+
+    def testMigrationKeepsANewerVote(self):
+        legacy = self.question.Vote(parent=self.questionKey, author=self.user(1), value='Up').put()
+        self.question.castVote(self.user(1), self.questionKey, 'Down')
+        #a legacy vote the vote above already replaced
+        self.question.Vote(key=legacy, author=self.user(1), value='Up').put()
+        self.question.migrateVote(legacy.get())
+        self.assertIsNone(legacy.get())
+        self.assertEqual(self.question.vote_key(self.user(1), self.questionKey).get().value, 'none')
+
+    def testAggregateFoldsTheShards(self):
+        for userId, value in ((1, 'Up'), (2, 'Up'), (3, 'Down'), (4, 'Up')):
+            self.question.castVote(self.user(userId), self.questionKey, value)
+        question = self.question.aggregateVotes(self.questionKey)
+        self.assertEqual(question.voteResult, 4)
+        self.assertEqual(self.questionKey.get().voteResult, 4)
+        self.assertEqual(self.questionKey.get().version, 2)
+        self.assertEqual(self.pending(self.questionKey), 0)
+        self.assertIsNone(self.question.aggregateVotes(self.questionKey))
+        self.assertEqual(self.questionKey.get().version, 2)
+
+    def testAnswerAggregateBumpsTheThreadVersion(self):
+        self.question.castVote(self.user(1), self.answerKey, 'Down')
+        answer = self.question.aggregateVotes(self.answerKey)
+        self.assertEqual(answer.voteResult, -1)
+        self.assertEqual(self.answerKey.get().voteResult, -1)
+        self.assertEqual(self.questionKey.get().version, 2)
+        self.assertEqual(self.questionKey.get().voteResult, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+"""Write-behind batching of the datastore writes, task adds and cache
+invalidations of one request.
+
+A UnitOfWork collects entity puts and deletes, tasks and calls such as
+cache invalidations. commit() issues every put in one put_multi and every
+delete in one delete_multi, both at once, inside one transaction when the
+writes span few enough entity groups. Then it adds the tasks with one
+batch per queue. Last, it makes each collected call once, with the items
+of every request for it. Nothing is written when the handler fails before
+the commit, and reads in the same request do not see pending writes.
+
+question.application runs every handler inside run(), and current()
+returns that request's unit of work. The module level put(), delete(),
+addTask() and collect() defer to it, and act at once when there is none,
+e.g. in bulkdata.py. Writes inside a transaction must not be deferred
+past it, so transactional helpers call write() or flush() a UnitOfWork
+of their own before they return.
+"""
+import collections
+import threading
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+MAX_GROUPS = 25 #entity groups one cross group transaction may span
+MAX_TRANSACTION_WRITES = 500 #larger batches are written without a transaction
+TASK_BATCH = 100 #tasks per queue add
+
+_local = threading.local()
+
+
+def current():
+    """ the unit of work of the request running on this thread, or None """
+    return getattr(_local, 'work', None)
+
+
+def run(function, *args):
+    """ call function with a fresh unit of work, commit it if function returns """
+    work = _local.work = UnitOfWork()
+    try:
+        result = function(*args)
+        work.commit()
+        return result
+    finally:
+        _local.work = None
+
+
+def addTasksAsync(queueName, tasks):
+    """ start adding tasks, a batch RPC per TASK_BATCH of them """
+    return [taskqueue.Queue(queueName).add_async(tasks[i:i + TASK_BATCH])
+            for i in range(0, len(tasks), TASK_BATCH)]
+
+
+def waitTasks(rpcs):
+    """ wait for task adds, named tasks that already existed are skipped """
+    for rpc in rpcs:
+        try:
+            rpc.get_result()
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            #the other tasks of the batch were added
+            pass
+
+
+def write(puts, deletes):
+    """ one put_multi and one delete_multi, issued together """
+    futures = ndb.put_multi_async(puts) + ndb.delete_multi_async(deletes)
+    for future in futures:
+        future.check_success()
+
+
+def countGroups(puts, deletes):
+    """ the number of entity groups written """
+    roots = set(key.root() for key in deletes)
+    newRoots = 0
+    for entity in puts:
+        if entity.key and (entity.key.id() or entity.key.parent()):
+            roots.add(entity.key.root())
+        else:
+            #a new root entity is a group of its own
+            newRoots += 1
+    return len(roots) + newRoots
+
+
+def put(*entities):
+    work = current()
+    if work is None:
+        ndb.put_multi(entities)
+    else:
+        work.put(*entities)
+
+
+def delete(*keys):
+    work = current()
+    if work is None:
+        ndb.delete_multi(keys)
+    else:
+        work.delete(*keys)
+
+
+def addTask(task, queueName='default'):
+    work = current()
+    if work is None:
+        waitTasks(addTasksAsync(queueName, [task]))
+    else:
+        work.addTask(task, queueName)
+
+
+def collect(function, *items):
+    work = current()
+    if work is None:
+        function(list(items))
+    else:
+        work.collect(function, *items)
+
+
+class UnitOfWork(object):
+    """ the pending writes, tasks and calls of one request """
+
+    def __init__(self):
+        self.writes = collections.OrderedDict() #key -> entity to put, None to delete
+        self.newEntities = [] #entities put without a complete key
+        self.tasks = collections.OrderedDict() #queue name -> {task name or index: task}
+        self.calls = collections.OrderedDict() #function -> OrderedDict of its items
+
+    def put(self, *entities):
+        """ put entities at the commit, the last put or delete of a key wins """
+        for entity in entities:
+            if entity.key and entity.key.id():
+                self.writes[entity.key] = entity
+            else:
+                self.newEntities.append(entity)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.writes[key] = None
+
+    def addTask(self, task, queueName='default'):
+        """ add task after the writes, one task of a name per queue """
+        tasks = self.tasks.setdefault(queueName, collections.OrderedDict())
+        tasks[task.name or len(tasks)] = task
+
+    def collect(self, function, *items):
+        """ call function once after the commit, with the items of every
+            collect naming it as one list, duplicates dropped """
+        calls = self.calls.setdefault(function, collections.OrderedDict())
+        for item in items:
+            calls[item] = True
+
+    def take(self):
+        """ the pending (puts, deletes), which stop being pending """
+        puts = [entity for entity in self.writes.values() if entity is not None] + self.newEntities
+        deletes = [key for key, entity in self.writes.items() if entity is None]
+        self.writes.clear()
+        self.newEntities = []
+        return puts, deletes
+
+    def flush(self):
+        """ write the pending puts and deletes now, inside the caller's
+            transaction if there is one """
+        write(*self.take())
+
+    def commit(self):
+        """ write the entities, atomically when the entity groups allow,
+            then add the tasks and make the collected calls """
+        puts, deletes = self.take()
+        count = len(puts) + len(deletes)
+        groups = countGroups(puts, deletes)
+        if count > 1 and groups <= MAX_GROUPS and count <= MAX_TRANSACTION_WRITES and \
+                not ndb.in_transaction():
+            #a retry writes the same lists again
+            ndb.transaction(lambda: write(puts, deletes), xg=groups > 1)
+        elif count:
+            write(puts, deletes)
+        #the batches of every queue are in flight at once
+        rpcs = []
+        for queueName, tasks in self.tasks.items():
+            rpcs.extend(addTasksAsync(queueName, list(tasks.values())))
+        self.tasks.clear()
+        waitTasks(rpcs)
+        calls = list(self.calls.items())
+        self.calls.clear()
+        for function, items in calls:
+            function(list(items))